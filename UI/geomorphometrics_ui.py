@@ -71,6 +71,14 @@ class Ui_Dialog(object):
         self.VRM.setChecked(True)
         self.VRM.setObjectName("VRM")
         self.gridLayout.addWidget(self.VRM, 1, 3, 1, 1)
+        self.multiscale = QtWidgets.QCheckBox(Dialog)
+        self.multiscale.setChecked(False)
+        self.multiscale.setObjectName("multiscale")
+        self.gridLayout.addWidget(self.multiscale, 2, 0, 1, 4)
+        self.tiled = QtWidgets.QCheckBox(Dialog)
+        self.tiled.setChecked(False)
+        self.tiled.setObjectName("tiled")
+        self.gridLayout.addWidget(self.tiled, 3, 0, 1, 4)
         self.verticalLayout.addLayout(self.gridLayout)
         self.line = QtWidgets.QFrame(Dialog)
         self.line.setFrameShape(QtWidgets.QFrame.HLine)
@@ -111,6 +119,8 @@ class Ui_Dialog(object):
         self.TRI.setText(_translate("Dialog", "TRI"))
         self.GC.setText(_translate("Dialog", "Gausian Curv."))
         self.VRM.setText(_translate("Dialog", "VRM"))
+        self.multiscale.setText(_translate("Dialog", "All scales in one cloud (multi-scale)"))
+        self.tiled.setText(_translate("Dialog", "Tiled (large binary PLY meshes)"))
 
 
 if __name__ == "__main__":
@@ -73,6 +73,10 @@ class Ui_Dialog(object):
         self.wholeframe_only.setEnabled(False)
         self.wholeframe_only.setObjectName("wholeframe_only")
         self.horizontalLayout_2.addWidget(self.wholeframe_only)
+        self.direct_raycast = QtWidgets.QCheckBox(Dialog)
+        self.direct_raycast.setEnabled(False)
+        self.direct_raycast.setObjectName("direct_raycast")
+        self.horizontalLayout_2.addWidget(self.direct_raycast)
         self.reproject_launch = QtWidgets.QPushButton(Dialog)
         self.reproject_launch.setEnabled(False)
         self.reproject_launch.setObjectName("reproject_launch")
@@ -89,6 +93,8 @@ class Ui_Dialog(object):
         self.hit_map_launch.setText(_translate("Dialog", "Generate hit maps"))
         self.label_3.setText(_translate("Dialog", "Annotations"))
         self.wholeframe_only.setText(_translate("Dialog", "Whole_Frame only"))
+        self.direct_raycast.setToolTip(_translate("Dialog", "Ray-cast the annotations pixels against the 3D model instead of using hit maps"))
+        self.direct_raycast.setText(_translate("Dialog", "Direct ray casting"))
         self.reproject_launch.setText(_translate("Dialog", "Reproject"))
 
 
@@ -0,0 +1,187 @@
+"""
+Parsed cache of BIIGLE annotation reports.
+
+A report is parsed once into a typed binary cache next to it (`<report>.cache/`): the scalar
+columns as a pickled DataFrame with categorical labels, the `points` and video `frames` cells as
+flat float64 arrays with offsets. The cache is keyed by the SHA-1 of the report, so an edited
+or replaced report is parsed again; the file size and modification time are also recorded so
+that an unchanged report is not even hashed again.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from utility import file_digest
+
+CACHE_SUFFIX = '.cache'
+CACHE_VERSION = 1
+
+IMAGE_REPORT = "img"
+VIDEO_REPORT = "video"
+
+
+def sniff_report_type(file_path):
+    """
+    Determines the type of report from its header line only.
+
+    Args:
+        file_path: The path to the report.
+
+    Returns:
+        str: The report type ("img" for image or "video" for video), None if unknown.
+    """
+    col = pd.read_csv(file_path, sep=",", nrows=0).columns[0]
+    if col == "annotation_label_id":
+        return IMAGE_REPORT
+    elif col == "video_annotation_label_id":
+        return VIDEO_REPORT
+    return None
+
+
+def _flatten(lists):
+    """Flattens lists of numbers (None being null) into float64 values, offsets and a null mask."""
+    null = np.array([x is None for x in lists], dtype=bool)
+    lengths = np.array([0 if x is None else len(x) for x in lists], dtype=np.int64)
+    values = np.fromiter((np.nan if v is None else v for x in lists if x is not None for v in x),
+                         dtype=np.float64, count=int(lengths.sum()))
+    return values, np.concatenate(([0], np.cumsum(lengths))).astype(np.int64), null
+
+
+def _unflatten(values, offsets, null=None):
+    if len(offsets) < 2:
+        return []
+    lists = [part.tolist() for part in np.split(np.asarray(values), np.asarray(offsets)[1:-1])]
+    if null is not None:
+        lists = [None if is_null else x for x, is_null in zip(lists, null)]
+    return lists
+
+
+def _parse(cell):
+    return json.loads(cell) if isinstance(cell, str) else None
+
+
+class ParsedReport:
+    """A parsed annotation report: typed table, flat points and, for video reports, flat frame times."""
+
+    def __init__(self, report_type, table, arrays):
+        self.report_type = report_type
+        self.table = table
+        self.arrays = arrays
+
+    @classmethod
+    def from_csv(cls, file_path):
+        """Parses a BIIGLE csv report."""
+        report_type = sniff_report_type(file_path)
+        table = pd.read_csv(file_path, sep=",")
+        points = [_parse(x) for x in table.pop('points').tolist()] if 'points' in table else []
+        arrays = {}
+        if report_type == VIDEO_REPORT:
+            # One list of keyframe points per annotation, a keyframe being a coordinate list or null
+            frames = [_parse(x) or [] for x in table.pop('frames').tolist()]
+            arrays['frames'], arrays['frames_offsets'], _ = _flatten(frames)
+            keyframes = [keyframe for annotation in points for keyframe in (annotation or [])]
+            arrays['points'], arrays['keyframe_offsets'], arrays['keyframe_null'] = _flatten(keyframes)
+            arrays['points_offsets'] = np.concatenate(
+                ([0], np.cumsum([len(annotation or []) for annotation in points]))).astype(np.int64)
+        else:
+            arrays['points'], arrays['points_offsets'], _ = _flatten([x or [] for x in points])
+        for col in table.columns:
+            if table[col].dtype == object or pd.api.types.is_string_dtype(table[col]):
+                table[col] = table[col].astype('category')
+        return cls(report_type, table, arrays)
+
+    @classmethod
+    def load(cls, cache_dir):
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        table = pd.read_pickle(os.path.join(cache_dir, 'table.pkl'))
+        with np.load(os.path.join(cache_dir, 'arrays.npz')) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+        return cls(meta['report_type'], table, arrays)
+
+    def save(self, cache_dir, meta):
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.isfile(os.path.join(cache_dir, 'meta.json')):
+            os.remove(os.path.join(cache_dir, 'meta.json'))
+        self.table.to_pickle(os.path.join(cache_dir, 'table.pkl'))
+        np.savez(os.path.join(cache_dir, 'arrays.npz'), **self.arrays)
+        # meta.json last, a cache without it is an incomplete write
+        with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+            json.dump({**meta, 'report_type': self.report_type}, f)
+
+    def __len__(self):
+        return len(self.table)
+
+    def points(self):
+        """
+        The parsed points of every annotation.
+
+        Returns:
+            list: Image reports: one [x0, y0, x1, y1, ...] list per annotation. Video reports: one list
+            per annotation of the keyframe coordinate lists (None for null keyframes).
+        """
+        if self.report_type == VIDEO_REPORT:
+            keyframes = _unflatten(self.arrays['points'], self.arrays['keyframe_offsets'], self.arrays['keyframe_null'])
+            offsets = self.arrays['points_offsets']
+            return [keyframes[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        return _unflatten(self.arrays['points'], self.arrays['points_offsets'])
+
+    def frames(self):
+        """The keyframe times of every annotation of a video report, NaN for null times."""
+        return _unflatten(self.arrays['frames'], self.arrays['frames_offsets'])
+
+    def annotations(self):
+        """The report as read by pandas, with parsed points (and frames) lists and object label columns."""
+        annotations = self.table.copy()
+        for col in annotations.columns:
+            if isinstance(annotations[col].dtype, pd.CategoricalDtype):
+                annotations[col] = annotations[col].astype(object)
+        annotations['points'] = self.points()
+        if self.report_type == VIDEO_REPORT:
+            annotations['frames'] = self.frames()
+        return annotations
+
+
+def cache_path(file_path):
+    return file_path + CACHE_SUFFIX
+
+
+def load_report(file_path):
+    """
+    Loads a parsed annotation report, from its cache when it is up to date, else parsing it and
+    writing the cache.
+
+    Args:
+        file_path: The path to the BIIGLE csv report.
+
+    Returns:
+        ParsedReport: The parsed report.
+    """
+    cache_dir = cache_path(file_path)
+    stat = os.stat(file_path)
+    meta = None
+    if os.path.isfile(os.path.join(cache_dir, 'meta.json')):
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if meta.get('version') != CACHE_VERSION:
+            meta = None
+    if meta is not None and meta['size'] == stat.st_size and meta['mtime_ns'] == stat.st_mtime_ns:
+        return ParsedReport.load(cache_dir)
+
+    digest = file_digest(file_path)
+    meta_update = {'version': CACHE_VERSION, 'sha1': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if meta is not None and meta['sha1'] == digest:  # Touched but unchanged
+        try:
+            with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+                json.dump({**meta, **meta_update}, f)
+        except OSError as e:  # Read-only project, the report is hashed again next time
+            print('Could not update the report cache {}: {}'.format(cache_dir, e))
+        return ParsedReport.load(cache_dir)
+    report = ParsedReport.from_csv(file_path)
+    try:
+        report.save(cache_dir, meta_update)
+    except OSError as e:  # Read-only project, the report is only parsed in memory
+        print('Could not write the report cache {}: {}'.format(cache_dir, e))
+    return report
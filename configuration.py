@@ -10,6 +10,7 @@ from UI.add_3D_model_ui import Ui_Dialog as Ui_Dialog_add_3D
 from UI.annotations_ui import Ui_Dialog as Ui_Dialog_annotations
 from PyQt5.QtWidgets import (QDialog, QFileDialog)
 from video_annotations import report_type
+from annotation_reports import load_report
 
 
 """
@@ -250,6 +251,7 @@ class AddAnnotations(QDialog, Ui_Dialog_annotations):
         if file_path != "" and os.path.exists(file_path):
             name = os.path.basename(file_path)
             rep_type = report_type(file_path)
+            load_report(file_path)  # Parse the report once, reprojections then read the cache
             self.qt.project_config['inputs']['annotations'].append({"name": name, "rep_type": rep_type, "path": file_path})
             update_interface(self.qt)
         else:
@@ -0,0 +1,143 @@
+"""
+Persistent spatial index of the geomorphometric point clouds.
+
+The points of a cloud are bucketed in a uniform XY grid (the clouds are 2.5D seafloor
+surfaces). The index is the permutation of the point indices sorted by grid cell and the start
+of every cell in it, so the points of a box are read from a few contiguous slices instead of
+scanning the whole cloud. It is built once per `cloud_metrics_<scale>.pcd` and saved next to it
+(`<pcd>.idx/`), and rebuilt when the size or modification time of the PCD changes.
+"""
+import json
+import os
+
+import numpy as np
+
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 1
+POINTS_PER_CELL = 64
+
+
+class CloudGridIndex:
+    """Uniform XY grid index of a point cloud, candidates = index.box(lower, upper)."""
+
+    def __init__(self, points, order, cell_start, origin, cell_size, shape):
+        """
+        Args:
+            points: The (n, 3) points of the cloud.
+            order: The point indices sorted by cell.
+            cell_start: The (nx * ny + 1) start of every cell in order, cell (i, j) being i * ny + j.
+            origin: The XY corner of cell (0, 0).
+            cell_size: The side of the cells.
+            shape: The (nx, ny) number of cells.
+        """
+        self.points = np.asarray(points)
+        self.order = order
+        self.cell_start = cell_start
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.cell_size = float(cell_size)
+        self.shape = tuple(int(x) for x in shape)
+
+    @classmethod
+    def build(cls, points, points_per_cell=POINTS_PER_CELL):
+        """
+        Args:
+            points: The (n, 3) points of the cloud.
+            points_per_cell: The mean number of points per cell over the XY bounding box.
+
+        Returns:
+            CloudGridIndex: The index.
+        """
+        points = np.asarray(points)
+        index_dtype = np.int32 if len(points) < np.iinfo(np.int32).max else np.int64
+        if len(points) == 0:
+            return cls(points, np.empty(0, dtype=index_dtype), np.zeros(2, dtype=np.int64), np.zeros(2), 1.0, (1, 1))
+        origin = points[:, :2].min(axis=0).astype(np.float64)
+        extent = points[:, :2].max(axis=0) - origin
+        area = max(float(extent[0] * extent[1]), 0.0)
+        cell_size = np.sqrt(area * points_per_cell / len(points)) if area > 0 else max(float(extent.max()), 1.0)
+        shape = np.floor(extent / cell_size).astype(np.int64) + 1
+        cells = cls._cells(points, origin, cell_size, shape)
+        order = np.argsort(cells, kind='stable').astype(index_dtype)
+        counts = np.bincount(cells, minlength=int(shape[0] * shape[1]))
+        cell_start = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        return cls(points, order, cell_start, origin, cell_size, shape)
+
+    @staticmethod
+    def _cells(points, origin, cell_size, shape):
+        ij = np.floor((points[:, :2] - origin) / cell_size).astype(np.int64)
+        np.clip(ij, 0, np.asarray(shape) - 1, out=ij)
+        return ij[:, 0] * shape[1] + ij[:, 1]
+
+    @classmethod
+    def load(cls, path, points):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        order = np.load(os.path.join(path, 'order.npy'), mmap_mode='r')
+        cell_start = np.load(os.path.join(path, 'cell_start.npy'))
+        return cls(points, order, cell_start, meta['origin'], meta['cell_size'], meta['shape'])
+
+    def save(self, path, meta):
+        os.makedirs(path, exist_ok=True)
+        if os.path.isfile(os.path.join(path, 'meta.json')):
+            os.remove(os.path.join(path, 'meta.json'))
+        np.save(os.path.join(path, 'order.npy'), self.order)
+        np.save(os.path.join(path, 'cell_start.npy'), self.cell_start)
+        # meta.json last, an index without it is an incomplete write
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({**meta, 'origin': self.origin.tolist(), 'cell_size': self.cell_size,
+                       'shape': list(self.shape)}, f)
+
+    def box(self, lower, upper):
+        """
+        Args:
+            lower: The (3,) lower corner of the box.
+            upper: The (3,) upper corner of the box.
+
+        Returns:
+            numpy.ndarray: The indices of the points in the [lower, upper] box.
+        """
+        lower = np.asarray(lower, dtype=np.float64)
+        upper = np.asarray(upper, dtype=np.float64)
+        if len(self.order) == 0 or np.any(lower > upper):
+            return np.empty(0, dtype=np.int64)
+        nx, ny = self.shape
+        i0, j0 = np.clip(np.floor((lower[:2] - self.origin) / self.cell_size).astype(np.int64), 0, [nx - 1, ny - 1])
+        i1, j1 = np.clip(np.floor((upper[:2] - self.origin) / self.cell_size).astype(np.int64), 0, [nx - 1, ny - 1])
+        # The cells j0..j1 of a column i are contiguous in order
+        candidates = [self.order[self.cell_start[i * ny + j0]:self.cell_start[i * ny + j1 + 1]]
+                      for i in range(i0, i1 + 1)]
+        candidates = np.concatenate(candidates).astype(np.int64)
+        p = self.points[candidates]
+        keep = np.all((p >= lower) & (p <= upper), axis=1)
+        return candidates[keep]
+
+
+def index_path(pcd_path):
+    return pcd_path + INDEX_SUFFIX
+
+
+def load_cloud_index(pcd_path, points):
+    """
+    Loads the spatial index of a PCD, building and saving it when missing or out of date.
+
+    Args:
+        pcd_path: The path to the PCD file.
+        points: The (n, 3) points read from the PCD, in file order.
+
+    Returns:
+        CloudGridIndex: The index of the points.
+    """
+    path = index_path(pcd_path)
+    stat = os.stat(pcd_path)
+    meta = {'version': INDEX_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'n_points': len(points)}
+    if os.path.isfile(os.path.join(path, 'meta.json')):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            saved = json.load(f)
+        if all(saved.get(key) == value for key, value in meta.items()):
+            return CloudGridIndex.load(path, points)
+    index = CloudGridIndex.build(points)
+    try:
+        index.save(path, meta)
+    except OSError:  # Read-only project, the index is only kept in memory
+        pass
+    return index
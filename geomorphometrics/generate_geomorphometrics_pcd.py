@@ -1,10 +1,23 @@
 import numpy as np
-import sys, os, math
+import sys, os
+from concurrent.futures import ProcessPoolExecutor
 
 print("Adding CloudCompare to sys path...")
 base_path = os.getcwd()
 sys.path.append(os.path.join(base_path, "reconstruction", "CloudCompare"))
 import reconstruction.CloudCompare.cloudComPy as cc
+from geomorphometrics.neighbourhood_metrics import (
+    NEIGHBOURHOOD_MEMORY_BUDGET, compute_multiscale_neighbourhood_metrics_parallel,
+    compute_neighbourhood_metrics_parallel,
+)
+
+from geomorphometrics.mesh_tiles import (
+    core_mask, open_ply, remove_tiles, save_tile_points, split_mesh, stitch_tiles, tile_size_for_budget,
+)
+from geomorphometrics.sample_cache import SampleCache, pcd_sample_key, save_pcd_sample_key
+
+MULTISCALE_PCD_NAME = 'cloud_metrics_multiscale.pcd'
+TILED_MEMORY_BUDGET = 16 * 2 ** 30
 
 
 def format_number(num):
@@ -12,75 +25,86 @@ def format_number(num):
     return int(num) if num % 1 == 0 else num
 
 
-def calc_vrm(points_vect):
-    X = 0
-    Y = 0
-    Z = 0
-    for point in points_vect:
-        X += point[0]
-        Y += point[1]
-        Z += point[2]
-    return 1 - (np.sqrt(np.square(X) + np.square(Y) + np.square(Z)) / len(points_vect))
-
-
-def calc_tri_bpi(ref, points, a0, a1, a2, a3):
-    TRI = 0
-    BPI = 0
-    d_ref = (a0 * ref[0] + a1 * ref[1] + a2 * ref[2] - a3) / math.sqrt(a0 ** 2 + a1 ** 2 + a2 ** 2)
-    for point in points:
-        d = (a0 * point[0] + a1 * point[1] + a2 * point[2] - a3) / math.sqrt(
-            a0 ** 2 + a1 ** 2 + a2 ** 2)  # Distance to plane
-        TRI += abs(d - d_ref)
-        BPI += d
-    TRI = TRI / len(points)
-    BPI = d_ref - (BPI / len(points))
-    return TRI, BPI
-
-
-def cpd_compute(cloud, octree, scale, level, vector):
-    np_tri = np.empty(shape=(len(cloud), 1))
-    np_bpi = np.empty(shape=(len(cloud), 1))
-    np_vrm = np.empty(shape=(len(cloud), 1))
-    n_cloud = cc.ccPointCloud("N_cloud")
-    for i in range(len(cloud)):
-        neighbours = octree.getPointsInSphericalNeighbourhood(cloud[i].tolist(), scale, level)
-        points = np.empty(shape=(len(neighbours), 3))
-        points_vect = np.empty(shape=(len(neighbours), 3))
-        for j in range(len(neighbours)):
-            points[j] = neighbours[j].point
-            id = neighbours[j].pointIndex
-            points_vect[j] = [vector[0][id], vector[1][id], vector[2][id]]
-
-        n_cloud.coordsFromNPArray_copy(points)
-        plane = cc.ccPlane.Fit(n_cloud)
-        if plane is not None:
-            a0, a1, a2, a3 = plane.getEquation()
-            np_tri[i], np_bpi[i] = calc_tri_bpi(cloud[i], points, a0, a1, a2, a3)
-            np_vrm[i] = calc_vrm(points_vect)
-        else:
-            np_tri[i], np_bpi[i], np_vrm[i] = np.nan, np.nan, np.nan
-    return [np_tri, np_bpi, np_vrm]
+def sampling_density(scale, target_nb_neighbours=10):
+    """Sampling density (points per square unit) giving about target_nb_neighbours points within scale of a point."""
+    density = target_nb_neighbours / (np.pi * scale ** 2)
+    density = max(density, 100)  # min density
+    density = min(density, 3000)  # max density
+    return density
 
 
-def generate_pcd(model, scale, output_path, metrics):
-    slope, aspect, roughness, tri, bpi, gm, gc, vrm = metrics
-    mesh = cc.loadMesh(model)
+def metric_field_names(scale):
+    """The names of the fields of every metric of one scale, in the order of the metric flags."""
+    suffix = '_{}_m'.format(str(scale))
+    names = ['slope_deg', 'aspect_deg', 'roughness', 'TRI', 'BPI', 'mean_curv', 'gaus_curv', 'VRM']
+    return [name + suffix for name in names]
 
-    target_nb_neighbours = 10
-    vector = None
 
-    density = target_nb_neighbours / (np.pi * scale ** 2)
-    density = max(density, 100)  # min density
-    density = min(density, 3000)  # max density
+def missing_metrics(field_names, scale, metrics):
+    """The metric flags of one scale restricted to the metrics without a field in field_names."""
+    return tuple(bool(flag) and name not in field_names for flag, name in zip(metrics, metric_field_names(scale)))
 
-    print('Model: {}, scale: {}, density: {}'.format(str(model), str(scale), str(density)))
 
+def sample_cloud(model, density, cache=None):
+    """
+    Samples the mesh at a density, or loads the sample of a previous run from the cache.
+
+    Returns:
+        The sampled ccPointCloud.
+    """
+    points = cache.load_points(density) if cache is not None else None
+    if points is not None:
+        print('Model: {}, density: {}, sample loaded from cache'.format(str(model), str(density)))
+        cloud = cc.ccPointCloud('sampled')
+        cloud.coordsFromNPArray_copy(points)
+        return cloud
+    mesh = cc.loadMesh(model)
     cloud = mesh.samplePoints(True, density)
-    np_cloud = cloud.toNpArrayCopy()
+    if cache is not None:
+        points = cloud.toNpArrayCopy()
+        cached = cache.save_points(density, points)
+        if cached is not points:  # Another scale cached its sample first, its dip fields go with it
+            cc.deleteEntity(cloud)
+            cloud = cc.ccPointCloud('sampled')
+            cloud.coordsFromNPArray_copy(cached)
+    return cloud
+
+
+def add_dip_fields(cloud, scale, density=None, cache=None):
+    """Adds the 'Dip (degrees)' and 'Dip direction (degrees)' fields of the normals at the scale, cached with the sample."""
+    dips = cache.load_dips(density, scale, cloud.size()) if cache is not None else None
+    if dips is not None:
+        for name, values in zip(('Dip (degrees)', 'Dip direction (degrees)'), dips):
+            sf_id = cloud.addScalarField(name)
+            cloud.getScalarField(sf_id).fromNpArrayCopy(values)
+        return
+    cc.computeNormals([cloud], model=cc.LOCAL_MODEL_TYPES.QUADRIC, defaultRadius=scale)
+    cloud.convertNormalToDipDirSFs()
+    if cache is not None:
+        dic = cloud.getScalarFieldDic()
+        cache.save_dips(density, scale, cloud.getScalarField(dic['Dip (degrees)']).toNpArrayCopy(),
+                        cloud.getScalarField(dic['Dip direction (degrees)']).toNpArrayCopy())
+
 
-    if slope or aspect:
-        cc.computeNormals([cloud], model=cc.LOCAL_MODEL_TYPES.QUADRIC, defaultRadius=scale)
-        cloud.convertNormalToDipDirSFs()
+def add_scale_metrics(cloud, scale, metrics, density=None, cache=None):
+    """
+    Adds the CloudCompare metrics of one scale (slope, aspect, roughness, curvatures) to the cloud.
+
+    Args:
+        cloud: The sampled ccPointCloud.
+        scale: The scale (radius) of the metrics.
+        metrics: The metric flags.
+        density: The sampling density of the cloud, the key of its cached dip fields.
+        cache: The SampleCache of the mesh, the normals are always estimated if None.
+
+    Returns:
+        numpy.ndarray: The (n, 3) unit normal vectors for VRM, None if not computed.
+    """
+    slope, aspect, roughness, tri, bpi, gm, gc, vrm = metrics
+    vector = None
+
+    if slope or aspect or vrm:  # VRM needs the normals even when slope and aspect are already computed
+        add_dip_fields(cloud, scale, density, cache)
 
         dic = cloud.getScalarFieldDic()
         if vrm:
@@ -92,10 +116,10 @@ def generate_pcd(model, scale, output_path, metrics):
             np_xy = np.sin(np_dip * (3.14 / 180))
             np_z = np.cos(np_dip * (3.14 / 180))
 
-            np_x = np.array([np_xy[i] * np.sin(np_dip_dir[i]) for i in range(len(np_xy))])
-            np_y = np.array([np_xy[i] * np.cos(np_dip_dir[i]) for i in range(len(np_xy))])
+            np_x = np_xy * np.sin(np_dip_dir)
+            np_y = np_xy * np.cos(np_dip_dir)
 
-            vector = [np_x, np_y, np_z]
+            vector = np.column_stack((np_x, np_y, np_z))
 
         dic = cloud.getScalarFieldDic()
         if slope:
@@ -142,44 +166,276 @@ def generate_pcd(model, scale, output_path, metrics):
         mean_curv = cloud.getScalarField(dic[key])
         mean_curv.setName('mean_curv_{}_m'.format(str(scale)))
 
+    return vector
+
+
+def add_neighbourhood_fields(cloud, scale, metrics, np_tri, np_bpi, np_vrm):
+    """Adds the TRI, BPI and VRM fields of one scale to the cloud."""
+    slope, aspect, roughness, tri, bpi, gm, gc, vrm = metrics
+    if tri:
+        TRI_id = cloud.addScalarField('TRI_{}_m'.format(str(scale)))  # TRI
+        cloud.getScalarField(TRI_id).fromNpArrayCopy(np_tri.reshape(-1, 1))
+    if bpi:
+        BPI_id = cloud.addScalarField('BPI_{}_m'.format(str(scale)))  # BPI
+        cloud.getScalarField(BPI_id).fromNpArrayCopy(np_bpi.reshape(-1, 1))
+    if vrm:
+        VRM_id = cloud.addScalarField('VRM_{}_m'.format(str(scale)))  # VRM
+        cloud.getScalarField(VRM_id).fromNpArrayCopy(np_vrm.reshape(-1, 1))
+
+
+def compute_pcd(model, scale, metrics, nb_processes=None, cache=None, cloud=None,
+                memory_budget=NEIGHBOURHOOD_MEMORY_BUDGET):
+    """
+    Samples the mesh for one scale and computes its metrics.
+
+    Args:
+        model: The path to the mesh.
+        scale: The scale (radius) of the metrics.
+        metrics: The metric flags.
+        nb_processes: Number of processes of the neighbourhood metrics, the number of CPUs if None.
+        cache: The SampleCache of the mesh, nothing is cached if None.
+        cloud: A ccPointCloud of the same sample (a previous PCD) to add the metrics to, sampled if None.
+        memory_budget: The memory available for the neighbourhoods of all the processes, in bytes.
+
+    Returns:
+        The ccPointCloud.
+    """
+    slope, aspect, roughness, tri, bpi, gm, gc, vrm = metrics
+    density = sampling_density(scale)
+
+    print('Model: {}, scale: {}, density: {}'.format(str(model), str(scale), str(density)))
+
+    if cloud is None:
+        cloud = sample_cloud(model, density, cache)
+    np_cloud = cloud.toNpArrayCopy()
+
+    vector = add_scale_metrics(cloud, scale, metrics, density, cache)
+
     if tri or bpi or vrm:
-        if tri:
-            TRI_id = cloud.addScalarField('TRI_{}_m'.format(str(scale)))  # TRI
-            TRI_sf = cloud.getScalarField(TRI_id)
+        np_tri, np_bpi, np_vrm = compute_neighbourhood_metrics_parallel(np_cloud, scale, vector, nb_processes,
+                                                                          memory_budget)
+        add_neighbourhood_fields(cloud, scale, metrics, np_tri, np_bpi, np_vrm)
+    return cloud
+
+
+def load_previous_pcd(pcd_path, sample_key, scales, metrics):
+    """
+    Loads the PCD of a previous run on the same sample, to only add the metrics it misses.
+
+    Args:
+        pcd_path: The path to the PCD.
+        sample_key: The key of the sample of the run (see SampleCache.sample_key).
+        scales: The scales of the PCD.
+        metrics: The metric flags of the run.
+
+    Returns:
+        tuple: The ccPointCloud (None when there is no PCD of the same sample) and the metric flags
+        left to compute for every scale.
+    """
+    if pcd_sample_key(pcd_path) != sample_key:
+        return None, {scale: tuple(metrics) for scale in scales}
+    cloud = cc.loadPointCloud(pcd_path)
+    field_names = set(cloud.getScalarFieldDic().keys())
+    return cloud, {scale: missing_metrics(field_names, scale, metrics) for scale in scales}
+
+
+def save_pcd(cloud, pcd_path, sample_key):
+    ret = cc.SavePointCloud(cloud, pcd_path)
+    save_pcd_sample_key(pcd_path, sample_key)
+    cc.deleteEntity(cloud)
 
-        if bpi:
-            BPI_id = cloud.addScalarField('BPI_{}_m'.format(str(scale)))  # BPI
-            BPI_sf = cloud.getScalarField(BPI_id)
 
-        if vrm:
-            VRM_id = cloud.addScalarField('VRM_{}_m'.format(str(scale)))  # BPI
-            VRM_sf = cloud.getScalarField(VRM_id)
-
-        octree = cloud.computeOctree(progressCb=None, autoAddChild=True)
-        level = octree.findBestLevelForAGivenNeighbourhoodSizeExtraction(scale)
-
-        nb_threads = 4
-        # np_cld_split = np.array_split(np_cloud, nb_threads)
-        # with concurrent.futures.ThreadPoolExecutor() as executor:
-        #    futures = [executor.submit(thread_cpd_compute, cloud_i, octree, scale, level) for cloud_i in np_cld_split]
-        #    results = [f.result() for f in futures]
-        np_tri, np_bpi, np_vrm = cpd_compute(np_cloud, octree, scale, level, vector)
-
-        # np_tri = np.vstack(list(i[0] for i in results))
-        # np_bpi = np.vstack(list(i[1] for i in results))
-
-        if tri:
-            TRI_sf.fromNpArrayCopy(np_tri)
-        if bpi:
-            BPI_sf.fromNpArrayCopy(np_bpi)
-        if vrm:
-            VRM_sf.fromNpArrayCopy(np_vrm)
+def generate_pcd(model, scale, output_path, metrics, nb_processes=None, memory_budget=NEIGHBOURHOOD_MEMORY_BUDGET):
+    """
+    Computes the metrics of one scale, saved as cloud_metrics_<scale>.pcd. When the PCD of a
+    previous run on the same sample exists, only the metrics it misses are computed and added to it.
+    The neighbourhood metrics hold at most memory_budget bytes of neighbourhoods at once.
 
+    Returns:
+        The scale.
+    """
     exp_pcd_path = os.path.join(output_path, 'cloud_metrics_{}.pcd'.format(str(scale)))
-    ret = cc.SavePointCloud(cloud, exp_pcd_path)
+    cache = SampleCache(model)
+    sample_key = cache.sample_key(sampling_density(scale))
 
-    cc.deleteEntity(cloud)
+    cloud, missing = load_previous_pcd(exp_pcd_path, sample_key, [scale], metrics)
+    if cloud is not None and not any(missing[scale]):
+        cc.deleteEntity(cloud)
+        print('Model: {}, scale: {}, up to date !'.format(str(model), str(scale)))
+        return scale
+
+    cloud = compute_pcd(model, scale, missing[scale], nb_processes, cache, cloud, memory_budget)
+    save_pcd(cloud, exp_pcd_path, sample_key)
 
     print('Model: {}, scale: {}, Done !'.format(str(model), str(scale)))
 
-    return scale
\ No newline at end of file
+    return scale
+
+
+def compute_multiscale_pcd(model, scales, metrics, nb_processes=None, cache=None, cloud=None,
+                           memory_budget=NEIGHBOURHOOD_MEMORY_BUDGET):
+    """
+    Samples the mesh once, at the density of the smallest scale, and computes the metrics of all
+    the scales on it. TRI, BPI and VRM come from a single neighbourhood query at the largest
+    scale, truncated to the smaller ones.
+
+    Args:
+        model: The path to the mesh.
+        scales: The scales (radii) of the metrics.
+        metrics: The metric flags, or a {scale: metric flags} dict.
+        nb_processes: Number of processes of the neighbourhood metrics, the number of CPUs if None.
+        cache: The SampleCache of the mesh, nothing is cached if None.
+        cloud: A ccPointCloud of the same sample (a previous PCD) to add the metrics to, sampled if None.
+        memory_budget: The memory available for the neighbourhoods of all the processes, in bytes.
+
+    Returns:
+        The ccPointCloud with the `*_<scale>_m` fields of every scale.
+    """
+    if not isinstance(metrics, dict):
+        metrics = {scale: tuple(metrics) for scale in scales}
+    density = sampling_density(min(scales))
+
+    print('Model: {}, scales: {}, density: {}'.format(str(model), str(scales), str(density)))
+
+    if cloud is None:
+        cloud = sample_cloud(model, density, cache)
+    np_cloud = cloud.toNpArrayCopy()
+
+    vectors = [add_scale_metrics(cloud, scale, metrics[scale], density, cache) for scale in scales]
+
+    # Only the scales missing TRI, BPI or VRM go through the neighbourhood query
+    neighbourhood = [k for k, scale in enumerate(scales) if any(metrics[scale][i] for i in (3, 4, 7))]
+    if len(neighbourhood) != 0:
+        results = compute_multiscale_neighbourhood_metrics_parallel(
+            np_cloud, [scales[k] for k in neighbourhood], [vectors[k] for k in neighbourhood], nb_processes,
+            memory_budget)
+        for k, (np_tri, np_bpi, np_vrm) in zip(neighbourhood, results):
+            add_neighbourhood_fields(cloud, scales[k], metrics[scales[k]], np_tri, np_bpi, np_vrm)
+    return cloud
+
+
+def generate_multiscale_pcd(model, scales, output_path, metrics, nb_processes=None,
+                            memory_budget=NEIGHBOURHOOD_MEMORY_BUDGET):
+    """
+    Computes the metrics of all the scales on a single sampled cloud, saved as
+    cloud_metrics_multiscale.pcd with `*_<scale>_m` fields for every scale. When the PCD of a
+    previous run on the same sample exists, only the fields it misses are computed and added to it.
+
+    Args:
+        model: The path to the mesh.
+        scales: The scales (radii) of the metrics.
+        output_path: The output directory.
+        metrics: The metric flags.
+        nb_processes: Number of processes of the neighbourhood metrics, the number of CPUs if None.
+        memory_budget: The memory available for the neighbourhoods of all the processes, in bytes.
+
+    Returns:
+        list: The scales.
+    """
+    exp_pcd_path = os.path.join(output_path, MULTISCALE_PCD_NAME)
+    cache = SampleCache(model)
+    sample_key = cache.sample_key(sampling_density(min(scales)))
+
+    cloud, missing = load_previous_pcd(exp_pcd_path, sample_key, scales, metrics)
+    if cloud is not None and not any(any(flags) for flags in missing.values()):
+        cc.deleteEntity(cloud)
+        print('Model: {}, scales: {}, up to date !'.format(str(model), str(scales)))
+        return scales
+
+    cloud = compute_multiscale_pcd(model, scales, missing, nb_processes, cache, cloud, memory_budget)
+    save_pcd(cloud, exp_pcd_path, sample_key)
+
+    print('Model: {}, scales: {}, Done !'.format(str(model), str(scales)))
+
+    return scales
+
+
+def pcd_names(scales, multiscale):
+    """The PCD names of a run and the scales each one holds."""
+    if multiscale:
+        return [(MULTISCALE_PCD_NAME, list(scales))]
+    return [('cloud_metrics_{}.pcd'.format(str(scale)), [scale]) for scale in scales]
+
+
+def generate_tile(tile, scales, multiscale, metrics, nb_processes=None, memory_budget=NEIGHBOURHOOD_MEMORY_BUDGET):
+    """
+    Computes the clouds of one tile and saves the points of its core (halo dropped) with their fields.
+
+    Args:
+        tile: The {'name', 'core', 'mesh_path'} tile (see mesh_tiles.split_mesh).
+        scales: The scales (radii) of the metrics.
+        multiscale: All the scales in one cloud.
+        metrics: The metric flags.
+        nb_processes: Number of processes of the neighbourhood metrics.
+        memory_budget: The memory available for the neighbourhoods of the tile, in bytes.
+
+    Returns:
+        list: The .npz of the tile, one per PCD name.
+    """
+    npz_paths = []
+    for pcd_name, pcd_scales in pcd_names(scales, multiscale):
+        if multiscale:
+            cloud = compute_multiscale_pcd(tile['mesh_path'], pcd_scales, metrics, nb_processes,
+                                           memory_budget=memory_budget)
+        else:
+            cloud = compute_pcd(tile['mesh_path'], pcd_scales[0], metrics, nb_processes, memory_budget=memory_budget)
+        points = cloud.toNpArrayCopy()
+        keep = core_mask(points, tile['core'])
+        dic = cloud.getScalarFieldDic()
+        fields = {name: cloud.getScalarField(dic[name]).toNpArrayCopy().reshape(-1)[keep] for name in dic.keys()}
+        npz_path = os.path.splitext(tile['mesh_path'])[0] + '_' + os.path.splitext(pcd_name)[0] + '.npz'
+        save_tile_points(npz_path, points[keep], fields)
+        cc.deleteEntity(cloud)
+        npz_paths.append(npz_path)
+    return npz_paths
+
+
+def generate_tiled_pcd(model, scales, output_path, metrics, multiscale=False, memory_budget=TILED_MEMORY_BUDGET,
+                       nb_processes=None):
+    """
+    Computes the geomorphometrics of a mesh too large for memory, tile by tile.
+
+    The mesh is split into tiles grown by a halo as wide as the largest scale, without loading
+    it. The tiles are processed in parallel, as many at once as the memory budget allows for
+    their size, and their core points are stitched into the same PCDs as the untiled run.
+
+    Args:
+        model: The path to the binary PLY mesh.
+        scales: The scales (radii) of the metrics.
+        output_path: The output directory.
+        metrics: The metric flags.
+        multiscale: All the scales in one cloud (see generate_multiscale_pcd).
+        memory_budget: The memory available for the tiles processed at once, in bytes.
+        nb_processes: Number of tiles processed at once, the number of CPUs (at most 4) if None.
+
+    Returns:
+        list: The scales.
+    """
+    nb_processes = nb_processes or min(4, os.cpu_count() or 1)
+    halo = max(scales)
+    density = sampling_density(min(scales))
+    vertices, _ = open_ply(model)
+    extent = (float(vertices['x'].max() - vertices['x'].min()), float(vertices['y'].max() - vertices['y'].min()))
+    del vertices
+    tile_size, neighbourhood_budget = tile_size_for_budget(extent, density, halo, memory_budget, nb_processes)
+    tiles_dir = os.path.join(output_path, 'geomorphometrics_tiles')
+
+    print('Model: {}, scales: {}, tile size: {}'.format(str(model), str(scales), str(tile_size)))
+    tiles = split_mesh(model, tiles_dir, tile_size, halo)
+    print('Model: {}, {} tiles'.format(str(model), str(len(tiles))))
+
+    # Each tile process gets its share of the cores for its neighbourhood metrics
+    nb_metric_processes = max(1, (os.cpu_count() or 1) // nb_processes)
+    with ProcessPoolExecutor(max_workers=nb_processes) as executor:
+        futures = [executor.submit(generate_tile, tile, scales, multiscale, metrics, nb_metric_processes,
+                                   neighbourhood_budget)
+                   for tile in tiles]
+        tile_npz = [future.result() for future in futures]
+
+    for k, (pcd_name, _) in enumerate(pcd_names(scales, multiscale)):
+        stitch_tiles([npz_paths[k] for npz_paths in tile_npz], os.path.join(output_path, pcd_name))
+    remove_tiles(tiles_dir)
+
+    print('Model: {}, scales: {}, Done !'.format(str(model), str(scales)))
+
+    return scales
@@ -6,9 +6,23 @@ from PyQt5.QtWidgets import (
 )
 
 from geomorphometrics.geomorphometrics_launcher import LaunchPCDThread
+from geomorphometrics.generate_geomorphometrics_pcd import pcd_names
 from UI.geomorphometrics_ui import Ui_Dialog
 
 
+def geomorphometrics_entries(model_name, model_path, scales, multiscale):
+    """The geomorphometrics entries of the project configuration, one per scale, the multi-scale ones sharing a cloud."""
+    entries = []
+    for pcd_name, pcd_scales in pcd_names(scales, multiscale):
+        for scale in pcd_scales:
+            entry = {'scale': scale, 'model_name': model_name,
+                     'pcd_path': os.path.join(os.path.dirname(model_path), pcd_name)}
+            if multiscale:
+                entry['multiscale'] = True
+            entries.append(entry)
+    return entries
+
+
 class EmittingStream(QtCore.QObject):
     textWritten = QtCore.pyqtSignal(str)
 
@@ -65,17 +79,14 @@ class GeomDialog(QDialog, Ui_Dialog):
             model_path = model['model_path']
             self.normalOutputWritten(f'Number of operations: {len(scales)} \r')
 
-            self.pcdThread = LaunchPCDThread(model_path, scales, metrics)
+            multiscale = self.multiscale.isChecked()
+            self.pcdThread = LaunchPCDThread(model_path, scales, metrics, multiscale, self.tiled.isChecked())
             self.pcdThread.prog_val.connect(self.set_prog)
             self.pcdThread.finished.connect(self.end_pcd)
             self.pcdThread.start()
 
-            self.project_config['outputs']['geomorphometrics'] = [{'scale': scale,
-                                                                   'model_name': model_name,
-                                                                   'pcd_path': os.path.join(
-                                                                       os.path.dirname(model_path),
-                                                                       'cloud_metrics_{}.pcd'.format(str(scale)))}
-                                                                  for scale in scales]
+            self.project_config['outputs']['geomorphometrics'] = geomorphometrics_entries(model_name, model_path,
+                                                                                          scales, multiscale)
         else:
             self.normalOutputWritten("Error: missing model \r")
 
@@ -1,24 +1,54 @@
 import subprocess, os
 from PyQt5 import QtCore
-import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 
-from geomorphometrics.generate_geomorphometrics_pcd import generate_pcd
+from geomorphometrics.generate_geomorphometrics_pcd import generate_multiscale_pcd, generate_pcd, generate_tiled_pcd
+from geomorphometrics.neighbourhood_metrics import NEIGHBOURHOOD_MEMORY_BUDGET
+from geomorphometrics.sample_cache import SampleCache
 
 
 class LaunchPCDThread(QtCore.QThread):
     prog_val = QtCore.pyqtSignal(int)
 
-    def __init__(self, model_path, scales, metrics):
+    def __init__(self, model_path, scales, metrics, multiscale=False, tiled=False):
         super(LaunchPCDThread, self).__init__()
         self.model_path = model_path
         self.scales = scales
         self.metrics = metrics
+        self.multiscale = multiscale
+        self.tiled = tiled
 
     def run(self):
-        nb_processes = 4
-        inputs = [[self.model_path, scale, os.path.dirname(self.model_path), self.metrics] for scale in self.scales]
-        with mp.Pool(processes=nb_processes) as pool:
-            pool.starmap(generate_pcd, inputs)
+        if self.tiled:
+            # Out-of-core: the mesh is split into tiles, processed in parallel within the memory budget
+            try:
+                generate_tiled_pcd(self.model_path, self.scales, os.path.dirname(self.model_path), self.metrics,
+                                   self.multiscale)
+            except ValueError as e:  # The memory budget cannot hold a tile
+                print("Error: {}".format(e))
+                return
+            print("Done")
+            return
+        if self.multiscale:
+            # All the scales in one cloud, computed by a single process using every core
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                executor.submit(generate_multiscale_pcd, self.model_path, self.scales,
+                                os.path.dirname(self.model_path), self.metrics, os.cpu_count()).result()
+            print("Done")
+            return
+        # Hashed once here, before the scales look up their cached samples in parallel
+        SampleCache(self.model_path).digest
+        nb_processes = min(4, len(self.scales))
+        # The cores and the memory are shared between the scales running at once, for their neighbourhood metrics
+        nb_metric_processes = max(1, (os.cpu_count() or 1) // max(nb_processes, 1))
+        memory_budget = NEIGHBOURHOOD_MEMORY_BUDGET // max(nb_processes, 1)
+        inputs = [[self.model_path, scale, os.path.dirname(self.model_path), self.metrics, nb_metric_processes,
+                   memory_budget] for scale in self.scales]
+        # ProcessPoolExecutor workers are not daemonic, so that each scale can start its own workers
+        with ProcessPoolExecutor(max_workers=max(nb_processes, 1)) as executor:
+            futures = [executor.submit(generate_pcd, *args) for args in inputs]
+            for future in futures:
+                future.result()
         print("Done")
 
 
@@ -0,0 +1,262 @@
+"""
+Out-of-core tiling of large meshes for the geomorphometrics.
+
+The XY extent of a binary PLY mesh is split into square tiles. Every tile is written as its own
+PLY with the faces overlapping the tile grown by a halo (the largest scale), so that the metrics
+of the points of the tile core see their whole neighbourhood. The mesh is never loaded as a
+whole: vertices and faces are memory-mapped and the faces are dispatched to the tiles chunk by
+chunk. Each tile is then processed on its own, its core points (the halo dropped) saved as a
+.npz, and the tiles are stitched into the final PCD, streamed one tile at a time.
+"""
+import glob
+import math
+import os
+
+import numpy as np
+
+from geomorphometrics.neighbourhood_metrics import BYTES_PER_PAIR
+
+PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1', 'short': 'i2', 'int16': 'i2',
+             'ushort': 'u2', 'uint16': 'u2', 'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+             'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+FACE_CHUNK = 5000000
+BYTES_PER_POINT = 1024  # Sampled point with its fields and normals, CloudCompare included
+NEIGHBOURHOOD_SHARE = 0.25  # Share of the budget of a tile for the neighbourhoods of its metrics
+MIN_CHUNK_POINTS = 1000  # Points whose neighbourhoods are held at once, at least
+
+
+def read_ply_header(ply_path):
+    """
+    Args:
+        ply_path: The path to the PLY file.
+
+    Returns:
+        tuple: The format, the elements [(name, count, [(property, type, list count type)])] and the header size.
+    """
+    elements = []
+    with open(ply_path, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError(f'{ply_path} is not a PLY file')
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError(f'{ply_path}: truncated PLY header')
+            words = line.decode('ascii').split()
+            if len(words) == 0 or words[0] in ('comment', 'obj_info'):
+                continue
+            if words[0] == 'format':
+                ply_format = words[1]
+            elif words[0] == 'element':
+                elements.append((words[1], int(words[2]), []))
+            elif words[0] == 'property':
+                if words[1] == 'list':
+                    elements[-1][2].append((words[4], PLY_TYPES[words[3]], PLY_TYPES[words[2]]))
+                else:
+                    elements[-1][2].append((words[2], PLY_TYPES[words[1]], None))
+            elif words[0] == 'end_header':
+                return ply_format, elements, f.tell()
+
+
+def open_ply(ply_path):
+    """
+    Memory-maps the vertices and triangles of a binary little endian PLY.
+
+    Returns:
+        tuple: The vertex structured array (x, y, z fields) and the (n, 3) face vertex indices.
+    """
+    ply_format, elements, offset = read_ply_header(ply_path)
+    if ply_format != 'binary_little_endian':
+        raise ValueError(f'{ply_path}: tiling needs a binary little endian PLY, not {ply_format}')
+    arrays = {}
+    for name, count, properties in elements:
+        fields = []
+        for prop, prop_type, count_type in properties:
+            if count_type is None:
+                fields.append((prop, '<' + prop_type))
+            else:  # Lists have a fixed size of 3 (triangles), checked below
+                fields += [(prop + '_count', '<' + count_type), (prop, '<' + prop_type, 3)]
+        dtype = np.dtype(fields)
+        arrays[name] = np.memmap(ply_path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+        offset += count * dtype.itemsize
+    vertices, faces = arrays['vertex'], arrays['face']
+    indices_name = next(name for name in faces.dtype.names if faces.dtype[name].shape == (3,))
+    for start in range(0, len(faces), FACE_CHUNK):
+        if np.any(faces[indices_name + '_count'][start:start + FACE_CHUNK] != 3):
+            raise ValueError(f'{ply_path}: tiling needs a triangle mesh')
+    return vertices, faces[indices_name]
+
+
+def write_ply(ply_path, vertices, faces):
+    """Writes a binary little endian PLY of float32 vertices and triangles."""
+    header = ('ply\nformat binary_little_endian 1.0\n'
+              f'element vertex {len(vertices)}\nproperty float x\nproperty float y\nproperty float z\n'
+              f'element face {len(faces)}\nproperty list uchar int vertex_indices\nend_header\n')
+    face_rows = np.empty(len(faces), dtype=[('n', 'u1'), ('v', '<i4', 3)])
+    face_rows['n'] = 3
+    face_rows['v'] = faces
+    with open(ply_path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        np.ascontiguousarray(vertices, dtype='<f4').tofile(f)
+        face_rows.tofile(f)
+
+
+def tile_size_for_budget(extent, density, halo, memory_budget, nb_processes):
+    """
+    Side of the tiles such that nb_processes tiles (halo included) fit in the memory budget.
+
+    A tile holds its points (BYTES_PER_POINT each) and the neighbourhoods of one chunk of them at
+    a time (see neighbourhood_metrics), a neighbourhood being about density * pi * halo ** 2 pairs.
+
+    Args:
+        extent: The (x, y) size of the mesh.
+        density: The sampling density (points per square unit).
+        halo: The width of the halo, the largest scale.
+        memory_budget: The memory available for the tiles processed at once, in bytes.
+        nb_processes: The number of tiles processed at once.
+
+    Returns:
+        tuple: The side of the tiles and the memory budget of the neighbourhoods of a tile, in bytes.
+
+    Raises:
+        ValueError: If the budget cannot hold a tile with a core at this density and halo.
+    """
+    tile_budget = memory_budget / nb_processes
+    pairs_per_point = density * math.pi * halo ** 2
+    neighbourhood_budget = max(tile_budget * NEIGHBOURHOOD_SHARE, MIN_CHUNK_POINTS * pairs_per_point * BYTES_PER_PAIR)
+    max_points = (tile_budget - neighbourhood_budget) / BYTES_PER_POINT
+    side = math.sqrt(max_points / density) - 2 * halo if max_points > 0 else 0
+    if side <= 0:
+        raise ValueError('A memory budget of {:.1f} GiB for {} tiles at once cannot hold a tile with a halo of {} '
+                         'at a density of {:.0f}, raise the budget or lower the number of tiles processed at once'
+                         .format(memory_budget / 2 ** 30, nb_processes, halo, density))
+    if side < halo:
+        print('Warning: tiles of {:.1f} for a halo of {}, most of the computation goes to the halos'.format(side, halo))
+    return min(side, max(extent)), int(neighbourhood_budget)
+
+
+def plan_tiles(bounds, tile_size):
+    """
+    Args:
+        bounds: The (xmin, ymin, xmax, ymax) of the mesh.
+        tile_size: The side of the tiles.
+
+    Returns:
+        list: The (name, (xmin, ymin, xmax, ymax)) cores of the tiles, covering the plane.
+    """
+    xmin, ymin, xmax, ymax = bounds
+    nx = max(1, math.ceil((xmax - xmin) / tile_size))
+    ny = max(1, math.ceil((ymax - ymin) / tile_size))
+    # The outer tiles are open towards the outside, so that the points on the mesh border are kept
+    x_edges = [-np.inf] + [xmin + i * tile_size for i in range(1, nx)] + [np.inf]
+    y_edges = [-np.inf] + [ymin + j * tile_size for j in range(1, ny)] + [np.inf]
+    tiles = []
+    for i in range(nx):
+        for j in range(ny):
+            tiles.append((f'tile_{i}_{j}', (x_edges[i], y_edges[j], x_edges[i + 1], y_edges[j + 1])))
+    return tiles
+
+
+def split_mesh(ply_path, tiles_dir, tile_size, halo):
+    """
+    Splits a mesh into tiles grown by a halo, without loading it as a whole.
+
+    Args:
+        ply_path: The path to the binary PLY mesh.
+        tiles_dir: The directory of the tile meshes.
+        tile_size: The side of the tiles.
+        halo: The width of the halo around the tiles.
+
+    Returns:
+        list: The {'name', 'core', 'mesh_path'} of the non empty tiles.
+    """
+    vertices, faces = open_ply(ply_path)
+    os.makedirs(tiles_dir, exist_ok=True)
+    bounds = [np.inf, np.inf, -np.inf, -np.inf]
+    for start in range(0, len(vertices), FACE_CHUNK):
+        chunk = vertices[start:start + FACE_CHUNK]
+        bounds = [min(bounds[0], chunk['x'].min()), min(bounds[1], chunk['y'].min()),
+                  max(bounds[2], chunk['x'].max()), max(bounds[3], chunk['y'].max())]
+    tiles = plan_tiles([float(x) for x in bounds], tile_size)
+    face_paths = {name: os.path.join(tiles_dir, name + '.faces') for name, _ in tiles}
+    for path in face_paths.values():
+        open(path, 'wb').close()
+
+    # Dispatch the faces to every tile their XY bounding box overlaps (halo included)
+    for start in range(0, len(faces), FACE_CHUNK):
+        chunk = np.asarray(faces[start:start + FACE_CHUNK])
+        x = vertices['x'][chunk.ravel()].reshape(-1, 3)
+        y = vertices['y'][chunk.ravel()].reshape(-1, 3)
+        face_min = np.column_stack((x.min(axis=1), y.min(axis=1)))
+        face_max = np.column_stack((x.max(axis=1), y.max(axis=1)))
+        for name, (xmin, ymin, xmax, ymax) in tiles:
+            overlaps = ((face_max[:, 0] >= xmin - halo) & (face_min[:, 0] <= xmax + halo)
+                        & (face_max[:, 1] >= ymin - halo) & (face_min[:, 1] <= ymax + halo))
+            if overlaps.any():
+                with open(face_paths[name], 'ab') as f:
+                    chunk[overlaps].astype('<i8').tofile(f)
+
+    result = []
+    for name, core in tiles:
+        tile_faces = np.fromfile(face_paths[name], dtype='<i8').reshape(-1, 3)
+        os.remove(face_paths[name])
+        if len(tile_faces) == 0:
+            continue
+        used, local_faces = np.unique(tile_faces, return_inverse=True)
+        xyz = np.column_stack([vertices[axis][used] for axis in ('x', 'y', 'z')])
+        mesh_path = os.path.join(tiles_dir, name + '.ply')
+        write_ply(mesh_path, xyz, local_faces.reshape(-1, 3))
+        result.append({'name': name, 'core': core, 'mesh_path': mesh_path})
+    return result
+
+
+def core_mask(points, core):
+    """Mask of the points in the [xmin, xmax) x [ymin, ymax) core of a tile."""
+    xmin, ymin, xmax, ymax = core
+    return (points[:, 0] >= xmin) & (points[:, 0] < xmax) & (points[:, 1] >= ymin) & (points[:, 1] < ymax)
+
+
+def save_tile_points(npz_path, points, fields):
+    """Saves the core points of a tile and their fields (name: values)."""
+    np.savez(npz_path, points=points, **{'field_' + name: values for name, values in fields.items()})
+
+
+def write_pcd_header(f, field_names, nb_points):
+    f.write(('# .PCD v0.7 - Point Cloud Data file format\n'
+             'VERSION 0.7\n'
+             f'FIELDS x y z {" ".join(field_names)}\n'
+             f'SIZE {" ".join(["4"] * (3 + len(field_names)))}\n'
+             f'TYPE {" ".join(["F"] * (3 + len(field_names)))}\n'
+             f'COUNT {" ".join(["1"] * (3 + len(field_names)))}\n'
+             f'WIDTH {nb_points}\nHEIGHT 1\nVIEWPOINT 0 0 0 1 0 0 0\n'
+             f'POINTS {nb_points}\nDATA binary\n').encode('ascii'))
+
+
+def stitch_tiles(npz_paths, pcd_path):
+    """
+    Stitches the core points of the tiles into one binary PCD, one tile in memory at a time.
+
+    Args:
+        npz_paths: The tile .npz files (see save_tile_points), with the same fields.
+        pcd_path: The output PCD.
+    """
+    field_names = None
+    nb_points = 0
+    for npz_path in npz_paths:
+        with np.load(npz_path) as npz:
+            names = [name[len('field_'):] for name in npz.files if name.startswith('field_')]
+            field_names = names if field_names is None else field_names
+            nb_points += len(npz['points'])
+    field_names = field_names or []
+    with open(pcd_path, 'wb') as f:
+        write_pcd_header(f, field_names, nb_points)
+        for npz_path in npz_paths:
+            with np.load(npz_path) as npz:
+                rows = np.column_stack([npz['points']] + [npz['field_' + name] for name in field_names])
+            np.ascontiguousarray(rows, dtype='<f4').tofile(f)
+
+
+def remove_tiles(tiles_dir):
+    for path in glob.glob(os.path.join(tiles_dir, 'tile_*')):
+        os.remove(path)
+    if os.path.isdir(tiles_dir) and not os.listdir(tiles_dir):
+        os.rmdir(tiles_dir)
@@ -0,0 +1,328 @@
+"""
+Batched neighbourhood metrics (TRI, BPI, VRM) of a sampled cloud.
+
+The spherical neighbourhoods of the points are radius queries on a KD-tree, returned as CSR
+arrays: the neighbours of point i are indices[indptr[i]:indptr[i + 1]] (the point itself
+included, as in the CloudCompare octree neighbourhoods). The least squares plane of every
+neighbourhood is fitted at once from the batched covariance matrices, and the metrics are
+reductions over the CSR segments:
+    TRI = mean(|d - d_ref|)         d the distance of a neighbour to the plane, d_ref the one of the point
+    BPI = d_ref - mean(d)
+    VRM = 1 - |sum(v)| / n          v the unit normal vectors of the n neighbours
+Neighbourhoods of less than 3 points have no plane, their metrics are NaN.
+
+Several scales are computed from a single query at the largest radius, each neighbourhood
+being truncated to the smaller radii (the neighbours are sorted by distance).
+
+The memory grows with the number of neighbour pairs, not of points: the points are processed
+in chunks sized so that their pairs (estimated from the mean neighbourhood size of a subsample
+of the cloud) fit in a memory budget, shared between the workers of a parallel run.
+
+compute_neighbourhood_metrics_parallel splits the cloud in contiguous slices over worker
+processes, the cloud and the results being shared memory arrays. A cKDTree cannot be placed in
+shared memory, every worker builds its own from the shared cloud once.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from utility import attach_array, share_array
+
+NEIGHBOURHOOD_MEMORY_BUDGET = 2 ** 30  # Neighbourhood buffers of one computation, all its workers together
+BYTES_PER_PAIR = 200  # A neighbour pair in the query records, the CSR arrays and the metric temporaries
+DENSITY_SAMPLE = 1000
+
+# Per-process state of a pool worker (shared memory handles, arrays and KD-tree)
+_worker = {}
+
+
+def radius_neighbourhoods(tree, points, radius):
+    """
+    Args:
+        tree: The cKDTree of the cloud.
+        points: The (n, 3) query points.
+        radius: The neighbourhood radius.
+
+    Returns:
+        tuple: The indptr (n + 1), indices and distances of the CSR neighbourhoods, sorted by
+        increasing distance within each neighbourhood.
+    """
+    pairs = cKDTree(points).sparse_distance_matrix(tree, radius, output_type='ndarray')
+    order = np.lexsort((pairs['v'], pairs['i']))
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(pairs['i'], minlength=len(points))))).astype(np.int64)
+    return indptr, pairs['j'][order], pairs['v'][order]
+
+
+def chunk_size_for_budget(tree, cloud, radius, memory_budget):
+    """
+    Args:
+        tree: The cKDTree of the cloud.
+        cloud: The (m, 3) cloud points.
+        radius: The largest neighbourhood radius.
+        memory_budget: The memory available for the neighbourhoods of a chunk, in bytes.
+
+    Returns:
+        int: The number of points whose neighbourhoods fit in the memory budget.
+    """
+    if len(cloud) == 0:
+        return 1
+    sample = cloud[::max(1, len(cloud) // DENSITY_SAMPLE)]
+    pairs_per_point = max(float(np.mean(tree.query_ball_point(sample, radius, return_length=True))), 1.0)
+    return max(1, int(memory_budget // (BYTES_PER_PAIR * pairs_per_point)))
+
+
+def _segment_sum(values, indptr):
+    """Sums of values over the CSR segments (0 for empty segments)."""
+    sums = np.zeros((len(indptr) - 1,) + values.shape[1:], dtype=np.float64)
+    counts = np.diff(indptr)
+    non_empty = counts > 0
+    if len(values) != 0:
+        sums[non_empty] = np.add.reduceat(values, indptr[:-1][non_empty], axis=0)
+    return sums
+
+
+def fit_planes(cloud, indptr, indices):
+    """
+    Least squares planes of the neighbourhoods, as ccPlane.Fit: the plane goes through the
+    centroid and its normal is the eigenvector of the smallest covariance eigenvalue.
+
+    Args:
+        cloud: The (m, 3) cloud points.
+        indptr: The CSR neighbourhoods indptr.
+        indices: The CSR neighbourhoods indices.
+
+    Returns:
+        tuple: The (n, 3) centroids, the (n, 3) unit normals (oriented towards +Z) and the (n,)
+        mask of the neighbourhoods with a plane.
+    """
+    counts = np.diff(indptr)
+    valid = counts >= 3
+    neighbours = cloud[indices]
+    centroids = _segment_sum(neighbours, indptr) / np.maximum(counts, 1)[:, None]
+    centered = neighbours - np.repeat(centroids, counts, axis=0)
+    del neighbours
+    # One coefficient at a time, rather than the (pairs, 3, 3) outer products
+    covariances = np.empty((len(counts), 3, 3))
+    for a in range(3):
+        for b in range(a, 3):
+            covariances[:, a, b] = covariances[:, b, a] = _segment_sum(centered[:, a] * centered[:, b], indptr)
+    normals = np.full((len(counts), 3), np.nan)
+    if valid.any():
+        _, eigenvectors = np.linalg.eigh(covariances[valid])
+        normals[valid] = eigenvectors[:, :, 0]  # Eigenvalues in ascending order
+    normals[normals[:, 2] < 0] *= -1
+    return centroids, normals, valid
+
+
+def neighbourhood_metrics(cloud, points, indptr, indices, vectors=None):
+    """
+    TRI, BPI and VRM of points from their CSR neighbourhoods in the cloud.
+
+    Args:
+        cloud: The (m, 3) cloud points.
+        points: The (n, 3) points.
+        indptr: The CSR neighbourhoods indptr of the points.
+        indices: The CSR neighbourhoods indices.
+        vectors: The (m, 3) unit normal vectors for VRM, VRM is NaN if None.
+
+    Returns:
+        tuple: The (n,) TRI, BPI and VRM arrays.
+    """
+    counts = np.diff(indptr)
+    centroids, normals, valid = fit_planes(cloud, indptr, indices)
+    n = np.maximum(counts, 1)
+    # d - d_ref of every neighbour, the plane offset cancels out
+    offsets = np.einsum('ij,ij->i', cloud[indices], np.repeat(normals, counts, axis=0))
+    offsets -= np.repeat(np.einsum('ij,ij->i', points, normals), counts)
+    tri = _segment_sum(np.abs(offsets), indptr) / n
+    bpi = -_segment_sum(offsets, indptr) / n
+    tri[~valid] = np.nan
+    bpi[~valid] = np.nan
+    vrm = np.full(len(counts), np.nan)
+    if vectors is not None:
+        sums = _segment_sum(np.asarray(vectors, dtype=np.float64)[indices], indptr)
+        vrm = 1 - np.linalg.norm(sums, axis=1) / n
+        vrm[~valid] = np.nan
+    return tri, bpi, vrm
+
+
+def truncate_neighbourhoods(indptr, indices, distances, radius):
+    """
+    Restricts CSR neighbourhoods to a smaller radius.
+
+    Args:
+        indptr: The CSR neighbourhoods indptr.
+        indices: The CSR neighbourhoods indices.
+        distances: The distances of the neighbours.
+        radius: The smaller radius.
+
+    Returns:
+        tuple: The indptr, indices and distances of the neighbours within radius.
+    """
+    keep = distances <= radius
+    counts = np.zeros(len(indptr) - 1, dtype=np.int64)
+    non_empty = np.diff(indptr) > 0
+    if len(keep) != 0:
+        counts[non_empty] = np.add.reduceat(keep.astype(np.int64), indptr[:-1][non_empty])
+    return np.concatenate(([0], np.cumsum(counts))).astype(np.int64), indices[keep], distances[keep]
+
+
+def compute_multiscale_neighbourhood_metrics(cloud, radii, vectors=None, tree=None, start=0, stop=None,
+                                             memory_budget=NEIGHBOURHOOD_MEMORY_BUDGET):
+    """
+    TRI, BPI and VRM of the points [start, stop) of a cloud at several scales, from a single
+    neighbourhood query at the largest radius truncated to every smaller one.
+
+    Args:
+        cloud: The (m, 3) cloud points.
+        radii: The neighbourhood radii (the scales).
+        vectors: One (m, 3) array of unit normal vectors per radius for VRM (VRM is NaN for None).
+        tree: The cKDTree of the cloud, built if None.
+        start: First point to compute.
+        stop: End of the points to compute, the end of the cloud if None.
+        memory_budget: The memory available for the neighbourhoods held at once, in bytes.
+
+    Returns:
+        numpy.ndarray: The (len(radii), 3, n) TRI, BPI and VRM of every radius.
+    """
+    cloud = np.asarray(cloud, dtype=np.float64)
+    vectors = [None] * len(radii) if vectors is None else vectors
+    if tree is None:
+        tree = cKDTree(cloud)
+    stop = len(cloud) if stop is None else stop
+    metrics = np.full((len(radii), 3, stop - start), np.nan)
+    chunk_size = chunk_size_for_budget(tree, cloud, max(radii), memory_budget)
+    for chunk_start in range(start, stop, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        points = cloud[chunk_start:chunk_stop]
+        neighbourhoods = radius_neighbourhoods(tree, points, max(radii))
+        for k, radius in enumerate(radii):
+            indptr, indices, _ = truncate_neighbourhoods(*neighbourhoods, radius)
+            metrics[k, :, chunk_start - start:chunk_stop - start] = neighbourhood_metrics(
+                cloud, points, indptr, indices, vectors[k])
+    return metrics
+
+
+def compute_neighbourhood_metrics(cloud, radius, vectors=None, tree=None, start=0, stop=None,
+                                  memory_budget=NEIGHBOURHOOD_MEMORY_BUDGET):
+    """
+    TRI, BPI and VRM of the points [start, stop) of a cloud.
+
+    Args:
+        cloud: The (m, 3) cloud points.
+        radius: The neighbourhood radius (the scale).
+        vectors: The (m, 3) unit normal vectors for VRM, VRM is NaN if None.
+        tree: The cKDTree of the cloud, built if None.
+        start: First point to compute.
+        stop: End of the points to compute, the end of the cloud if None.
+        memory_budget: The memory available for the neighbourhoods held at once, in bytes.
+
+    Returns:
+        tuple: The (n,) TRI, BPI and VRM arrays.
+    """
+    tri, bpi, vrm = compute_multiscale_neighbourhood_metrics(cloud, [radius], [vectors], tree, start, stop,
+                                                             memory_budget)[0]
+    return tri, bpi, vrm
+
+
+def init_worker(cloud_desc, vectors_descs, output_desc):
+    """Pool initializer: attach to the shared cloud, vectors and output, and build the KD-tree once per worker."""
+    _worker['shm'] = []
+
+    def attach(descriptor):
+        if descriptor is None:
+            return None
+        shm, array = attach_array(descriptor)
+        _worker['shm'].append(shm)
+        return array
+
+    _worker['cloud'] = attach(cloud_desc)
+    _worker['vectors'] = [attach(descriptor) for descriptor in vectors_descs]
+    _worker['output'] = attach(output_desc)
+    _worker['tree'] = cKDTree(_worker['cloud'])
+
+
+def metrics_task(args):
+    """Computes the metrics of the points [start, stop) and writes them into the shared (n_radii, 3, n) output."""
+    radii, start, stop, memory_budget = args
+    _worker['output'][:, :, start:stop] = compute_multiscale_neighbourhood_metrics(
+        _worker['cloud'], radii, _worker['vectors'], _worker['tree'], start, stop, memory_budget)
+    return stop - start
+
+
+def compute_multiscale_neighbourhood_metrics_parallel(cloud, radii, vectors=None, nb_processes=None,
+                                                      memory_budget=NEIGHBOURHOOD_MEMORY_BUDGET):
+    """
+    TRI, BPI and VRM of all the points of a cloud at several scales, split in contiguous slices
+    over worker processes.
+
+    The cloud, the vectors and the (len(radii), 3, n) output are published in shared memory,
+    every worker computes its slice and writes it straight into the output, in chunks fitting
+    its share of the memory budget.
+
+    Args:
+        cloud: The (n, 3) cloud points.
+        radii: The neighbourhood radii (the scales).
+        vectors: One (n, 3) array of unit normal vectors per radius for VRM (VRM is NaN for None).
+        nb_processes: Number of worker processes (and of slices), the number of CPUs if None.
+        memory_budget: The memory available for the neighbourhoods of all the workers, in bytes.
+
+    Returns:
+        numpy.ndarray: The (len(radii), 3, n) TRI, BPI and VRM of every radius.
+    """
+    cloud = np.asarray(cloud, dtype=np.float64)
+    vectors = [None] * len(radii) if vectors is None else vectors
+    nb_processes = nb_processes or os.cpu_count() or 1
+    if nb_processes <= 1 or len(cloud) < 2 * nb_processes:
+        return compute_multiscale_neighbourhood_metrics(cloud, radii, vectors, memory_budget=memory_budget)
+
+    blocks = []
+
+    def share(array):
+        if array is None:
+            return None
+        blocks.append(share_array(np.asarray(array, dtype=np.float64)))
+        return blocks[-1][1]
+
+    try:
+        cloud_desc = share(cloud)
+        vectors_descs = [share(x) for x in vectors]
+        output_desc = share(np.full((len(radii), 3, len(cloud)), np.nan))
+        bounds = np.linspace(0, len(cloud), nb_processes + 1).astype(np.int64)
+        # Each worker holds the neighbourhoods of its chunks at once, the budget is split between them
+        worker_budget = memory_budget // nb_processes
+        tasks = [(list(radii), start, stop, worker_budget) for start, stop in zip(bounds[:-1], bounds[1:])]
+        # Not a multiprocessing.Pool: its daemonic workers could not run inside the scales pool
+        with ProcessPoolExecutor(max_workers=nb_processes, initializer=init_worker,
+                                 initargs=(cloud_desc, vectors_descs, output_desc)) as executor:
+            list(executor.map(metrics_task, tasks))
+        output = np.ndarray((len(radii), 3, len(cloud)), dtype=np.float64, buffer=blocks[-1][0].buf)
+        metrics = output.copy()
+        del output  # Releases the buffer before closing the block
+    finally:
+        for shm, _ in blocks:
+            shm.close()
+            shm.unlink()
+    return metrics
+
+
+def compute_neighbourhood_metrics_parallel(cloud, radius, vectors=None, nb_processes=None,
+                                           memory_budget=NEIGHBOURHOOD_MEMORY_BUDGET):
+    """
+    TRI, BPI and VRM of all the points of a cloud, split in contiguous slices over worker processes.
+
+    Args:
+        cloud: The (n, 3) cloud points.
+        radius: The neighbourhood radius (the scale).
+        vectors: The (n, 3) unit normal vectors for VRM, VRM is NaN if None.
+        nb_processes: Number of worker processes (and of slices), the number of CPUs if None.
+        memory_budget: The memory available for the neighbourhoods of all the workers, in bytes.
+
+    Returns:
+        tuple: The (n,) TRI, BPI and VRM arrays.
+    """
+    tri, bpi, vrm = compute_multiscale_neighbourhood_metrics_parallel(cloud, [radius], [vectors], nb_processes,
+                                                                      memory_budget)[0]
+    return tri, bpi, vrm
@@ -0,0 +1,172 @@
+"""
+On-disk cache of the sampled clouds of the geomorphometrics.
+
+Sampling the mesh and estimating the normals are a large share of the runtime of a scale and
+do not depend on the metrics asked for. The sampled points are cached per (mesh hash, density)
+and the dip and dip direction fields per (mesh hash, density, normal radius), in
+`geomorphometrics_cache/` next to the mesh. The hash of the mesh content is itself cached
+against the size and modification time of the mesh, so the mesh is only read again when it
+changes.
+
+Every PCD written from a cached sample gets a `<pcd>.json` sidecar recording the sample it was
+computed on, so a later run can load the PCD and only add the fields it misses.
+"""
+import json
+import os
+
+import numpy as np
+
+from utility import file_digest
+
+CACHE_DIR_NAME = 'geomorphometrics_cache'
+CACHE_VERSION = 1
+
+
+def _format_key(value):
+    return '{:.6g}'.format(float(value))
+
+
+def _write_json(path, content):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(content, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+class SampleCache:
+    """Cache of the sampled points and dip fields of one mesh."""
+
+    def __init__(self, mesh_path, cache_dir=None):
+        """
+        Args:
+            mesh_path: The path to the mesh.
+            cache_dir: The cache directory, `geomorphometrics_cache/` next to the mesh if None.
+        """
+        self.mesh_path = mesh_path
+        self.cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(mesh_path)), CACHE_DIR_NAME)
+        self._digest = None
+
+    @property
+    def digest(self):
+        """The SHA-1 of the mesh content, only recomputed when the size or modification time of the mesh change."""
+        if self._digest is None:
+            stat = os.stat(self.mesh_path)
+            meta = {'version': CACHE_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            hash_path = os.path.join(self.cache_dir, os.path.basename(self.mesh_path) + '.sha1.json')
+            saved = _read_json(hash_path)
+            if saved is not None and all(saved.get(key) == value for key, value in meta.items()):
+                self._digest = saved['sha1']
+            else:
+                self._digest = file_digest(self.mesh_path)
+                try:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    _write_json(hash_path, {**meta, 'sha1': self._digest})
+                except OSError:  # Read-only project, the hash is only kept in memory
+                    pass
+        return self._digest
+
+    def sample_key(self, density):
+        """The key of the sample of the mesh at a density, recorded in the PCD sidecars."""
+        return '{}_d{}'.format(self.digest, _format_key(density))
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def load_points(self, density):
+        """
+        Returns:
+            numpy.ndarray: The (n, 3) sampled points of the mesh at the density, None if not cached.
+        """
+        path = self._path(self.sample_key(density) + '_points.npy')
+        return np.load(path) if os.path.isfile(path) else None
+
+    def save_points(self, density, points):
+        """
+        Caches the sampled points of the mesh at the density, unless another process cached its own
+        sample first: the first sample wins, so that the cached dip fields always match it.
+
+        Returns:
+            numpy.ndarray: The cached points, to use instead of points when they differ.
+        """
+        name = self.sample_key(density) + '_points.npy'
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = self._path('{}.{}.tmp.npy'.format(name, os.getpid()))
+            np.save(tmp_path, points)
+            try:
+                os.link(tmp_path, self._path(name))  # Create-if-absent, atomic
+            except FileExistsError:
+                return np.load(self._path(name))
+            finally:
+                os.remove(tmp_path)
+        except OSError:  # Read-only project (or no hard links), nothing is cached
+            pass
+        return points
+
+    def load_dips(self, density, radius, nb_points):
+        """
+        Args:
+            density: The sampling density.
+            radius: The radius of the normal estimation.
+            nb_points: The number of points of the sample, to check the fields against.
+
+        Returns:
+            tuple: The dip and dip direction (degrees) of every point, None if not cached.
+        """
+        path = self._path('{}_r{}_dips.npy'.format(self.sample_key(density), _format_key(radius)))
+        if not os.path.isfile(path):
+            return None
+        dips = np.load(path)
+        if len(dips) != nb_points:
+            return None
+        return dips[:, 0], dips[:, 1]
+
+    def save_dips(self, density, radius, dip, dip_dir):
+        dips = np.column_stack((np.asarray(dip).reshape(-1), np.asarray(dip_dir).reshape(-1))).astype(np.float32)
+        self._save('{}_r{}_dips.npy'.format(self.sample_key(density), _format_key(radius)), dips)
+
+    def _save(self, name, array):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Written aside and renamed, a cache entry is never partially written
+            tmp_path = self._path('{}.{}.tmp.npy'.format(name, os.getpid()))
+            np.save(tmp_path, array)
+            os.replace(tmp_path, self._path(name))
+        except OSError:  # Read-only project, nothing is cached
+            pass
+
+
+def sidecar_path(pcd_path):
+    return pcd_path + '.json'
+
+
+def pcd_sample_key(pcd_path):
+    """
+    Returns:
+        str: The sample key the PCD was computed on, None if unknown or if the PCD changed since.
+    """
+    if not os.path.isfile(pcd_path):
+        return None
+    saved = _read_json(sidecar_path(pcd_path))
+    if saved is None:
+        return None
+    stat = os.stat(pcd_path)
+    if saved.get('size') != stat.st_size or saved.get('mtime_ns') != stat.st_mtime_ns:
+        return None
+    return saved.get('sample_key')
+
+
+def save_pcd_sample_key(pcd_path, sample_key):
+    stat = os.stat(pcd_path)
+    try:
+        _write_json(sidecar_path(pcd_path), {'version': CACHE_VERSION, 'sample_key': sample_key,
+                                             'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+    except OSError:
+        pass
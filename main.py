@@ -146,6 +146,7 @@ class Window(QMainWindow, Ui_MainWindow):
         self.camera_cb.currentTextChanged.connect(
             lambda: configuration.set_camera_model(self.project_config, self.camera_cb.currentText()))
         self.geoms_scales.currentTextChanged.connect(lambda: self.populate_cb(True))
+        self.geoms_scalar.currentTextChanged.connect(lambda: pv_utils.update_geomorphometrics_scalar(self))
 
     def populate_cb(self, only_scalar = False):
         if not only_scalar:
@@ -155,9 +156,12 @@ class Window(QMainWindow, Ui_MainWindow):
             self.camera_cb.addItems(list(self.available_cameras.keys()))
             self.geoms_scales.addItems(utility.get_geomorphometrics_scales(self.project_config))
 
+        # Repopulating is not a scalar selection, the view is only recolored on user choices
+        self.geoms_scalar.blockSignals(True)
         self.geoms_scalar.clear()
         self.geoms_scalar.addItems(
             utility.get_geomorphometric_scalars(self.project_config, self.geoms_scales.currentText()))
+        self.geoms_scalar.blockSignals(False)
 
 
 
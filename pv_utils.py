@@ -2,11 +2,15 @@ import pyvista as pv
 import trimesh
 import numpy as np
 import os
+from collections import OrderedDict
 import pandas as pd
 from pyntcloud import PyntCloud
 import camera
 import coord_conversions
 from openmvg_json_file_handler import OpenMVGJSONFileHandler
+from reprojection.annotation_store import POINTS, POLYGONS, load_reprojected
+
+POINT_CLOUD_CACHE_BYTES = 4 * 2 ** 30
 
 
 def add_3d_cameras(qt):
@@ -93,24 +97,81 @@ def add_3d_models(qt):
         qt.plotter_actors['3D_models'] = []
 
 
+def read_point_cloud(pcd_path):
+    """
+    Reads a geomorphometrics PCD into a point cloud with its metrics as point scalars.
+
+    Args:
+        pcd_path: The path to the PCD file.
+
+    Returns:
+        pyvista.PolyData: The point cloud.
+    """
+    pcd = PyntCloud.from_file(pcd_path)
+    point_cloud = pv.PolyData(np.asarray(pcd.points[['x', 'y', 'z']]))
+    scalars = pcd.points.columns.to_list()
+    scalars = [x for x in scalars if
+               not (x.startswith("__") or x.startswith("normal_") or x in ["x", "y", "z"])]
+    for scalar in scalars:
+        point_cloud[scalar] = pcd.points[[scalar]]
+    return point_cloud
+
+
+class PointCloudCache:
+    """In-process LRU cache of the loaded point clouds, keyed by PCD path and modification time."""
+
+    def __init__(self, max_bytes=POINT_CLOUD_CACHE_BYTES):
+        """
+        Args:
+            max_bytes: Memory budget of the cached clouds, the least recently used ones are dropped
+                beyond it (the last loaded cloud is always kept).
+        """
+        self.max_bytes = max_bytes
+        self._clouds = OrderedDict()  # pcd_path: (mtime_ns, nbytes, point_cloud)
+
+    def get(self, pcd_path):
+        """The point cloud of a PCD, read again if it was modified since it was cached."""
+        mtime_ns = os.stat(pcd_path).st_mtime_ns
+        entry = self._clouds.get(pcd_path)
+        if entry is not None and entry[0] == mtime_ns:
+            self._clouds.move_to_end(pcd_path)
+            return entry[2]
+        point_cloud = read_point_cloud(pcd_path)
+        self._clouds[pcd_path] = (mtime_ns, point_cloud.actual_memory_size * 1024, point_cloud)
+        self._clouds.move_to_end(pcd_path)
+        self._evict()
+        return point_cloud
+
+    def _evict(self):
+        while len(self._clouds) > 1 and sum(entry[1] for entry in self._clouds.values()) > self.max_bytes:
+            self._clouds.popitem(last=False)
+
+    def set_budget(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def clear(self):
+        self._clouds.clear()
+
+
+point_cloud_cache = PointCloudCache()
+
+
 def parse_point_clouds(geomorphometrics):
-    pcd_path_list = [geomorphometric['pcd_path'] for geomorphometric in geomorphometrics]
-    point_cloud_list = []
-    for pcd_path in pcd_path_list:
-        pcd = PyntCloud.from_file(pcd_path)
-        point_cloud = pv.PolyData(np.asarray(pcd.points[['x', 'y', 'z']]))
-        scalars = pcd.points.columns.to_list()
-        scalars = [x for x in scalars if
-                   not (x.startswith("__") or x.startswith("normal_") or x in ["x", "y", "z"])]
-        for scalar in scalars:
-            point_cloud[scalar] = pcd.points[[scalar]]
-        point_cloud_list.append(point_cloud)
-    return point_cloud_list
+    return [point_cloud_cache.get(geomorphometric['pcd_path']) for geomorphometric in geomorphometrics]
+
+
+def get_geomorphometric(project_config, scale):
+    """The geomorphometrics entry of a scale (as shown in the scale combo box), None if unknown."""
+    geomorphometrics = project_config['outputs']['geomorphometrics']
+    if scale == '':
+        return None
+    return next((item for item in geomorphometrics if item["scale"] == float(scale)), None)
 
 
 def add_geomorphometrics(qt):
     """
-    Adds 3D models to the plotter based on the project configuration.
+    Adds the point cloud of the selected geomorphometrics scale to the plotter, colored by the selected scalar.
 
     Args:
         qt: The main window object.
@@ -119,24 +180,55 @@ def add_geomorphometrics(qt):
         None.
     """
     plotter, project_config = qt.plotter, qt.project_config
+    for actor in qt.plotter_actors['geomorphometrics']:
+        _ = plotter.remove_actor(actor)
+    qt.plotter_actors['geomorphometrics'] = []
     if qt.GeomLayer.isChecked():
         geomorphometrics = project_config['outputs']['geomorphometrics']
-        scale = qt.geoms_scales.currentText()
         scalar = qt.geoms_scalar.currentText()
-        if len(geomorphometrics) == 0:
+        geomorphometric = get_geomorphometric(project_config, qt.geoms_scales.currentText())
+        if len(geomorphometrics) == 0 or geomorphometric is None:
             print("Missing geomorphometrics !")
         else:
-            point_cloud_list = parse_point_clouds(geomorphometrics)
-            point_id = next((i for i, item in enumerate(geomorphometrics) if item["scale"] == float(scale)), None)
-            point_cloud = point_cloud_list[point_id]
+            # Only the displayed scale is loaded
+            point_cloud = point_cloud_cache.get(geomorphometric['pcd_path'])
 
             plotter.enable_eye_dome_lighting()
-            actor = plotter.add_mesh(point_cloud, scalars=point_cloud[scalar])
+            actor = plotter.add_mesh(point_cloud, scalars=scalar)
             qt.plotter_actors['geomorphometrics'].append(actor)
-    else:
-        for actor in qt.plotter_actors['geomorphometrics']:
-            _ = plotter.remove_actor(actor)
-        qt.plotter_actors['geomorphometrics'] = []
+
+
+def update_geomorphometrics_scalar(qt):
+    """
+    Colors the displayed geomorphometrics by the selected scalar, reusing the actor when the
+    displayed scale did not change.
+
+    Args:
+        qt: The main window object.
+
+    Returns:
+        None.
+    """
+    plotter, project_config = qt.plotter, qt.project_config
+    scalar = qt.geoms_scalar.currentText()
+    if not qt.GeomLayer.isChecked() or scalar == '':
+        return
+    geomorphometric = get_geomorphometric(project_config, qt.geoms_scales.currentText())
+    actors = qt.plotter_actors['geomorphometrics']
+    point_cloud = None
+    if geomorphometric is not None and len(actors) == 1:
+        point_cloud = point_cloud_cache.get(geomorphometric['pcd_path'])
+    if point_cloud is None or actors[0].mapper.dataset is not point_cloud or scalar not in point_cloud.point_data:
+        add_geomorphometrics(qt)  # Other scale, or the cloud was modified
+        return
+    mapper = actors[0].mapper
+    if mapper.array_name != scalar:
+        plotter.remove_scalar_bar(mapper.array_name, render=False)
+        point_cloud.set_active_scalars(scalar)
+        mapper.array_name = scalar
+        mapper.scalar_range = point_cloud.get_data_range(scalar)
+        plotter.add_scalar_bar(title=scalar, mapper=mapper)
+        plotter.render()
 
 
 def add_nav_camera(qt):
@@ -214,21 +306,18 @@ def add_3d_annotations(qt):
         annotations = project_config['outputs']['reprojected_annotations']
         if ann_dir := annotations[0]["reprojected_annotation_dir"]:
             plotter.enable_anti_aliasing('ssaa')
-            points_pd = pd.read_pickle(os.path.join(ann_dir, "points.pkl"))
-            if len(points_pd) > 0:
-                points = points_pd['points'].to_list()
+            points = load_reprojected(ann_dir, POINTS)
+            if len(points) > 0:
                 actor = plotter.add_points(
-                    np.array(points, dtype='float'), render_points_as_spheres=True, point_size=10.0, color = 'red',
+                    np.asarray(points.coords, dtype='float'), render_points_as_spheres=True, point_size=10.0, color = 'red',
                 )
                 qt.plotter_actors['3D_annotations'].append(actor)
 
-            polygons_pd = pd.read_pickle(os.path.join(ann_dir, "polygons.pkl"))
-            if len(polygons_pd) > 0:
-                polygons = polygons_pd['points'].to_list()
-                for polygon in polygons:
-                    polygon.append(polygon[0])
-                    actor = plotter.add_lines(np.array(polygon, dtype='float'), connected=True, color='purple', width=3)
-                    qt.plotter_actors['3D_annotations'].append(actor)
+            polygons = load_reprojected(ann_dir, POLYGONS)
+            for polygon in polygons.geometries():
+                polygon = np.concatenate([polygon, polygon[:1]])
+                actor = plotter.add_lines(np.array(polygon, dtype='float'), connected=True, color='purple', width=3)
+                qt.plotter_actors['3D_annotations'].append(actor)
 
         else:
             print("Missing reprojected_annotations data !")
@@ -0,0 +1,195 @@
+"""
+Columnar store of the reprojected annotations.
+
+Each geometry kind (points, lines, polygons) of a reprojected annotations directory is a
+sub-directory of .npy columns:
+    coords.npy      float64 (n_vertices, 3), the vertices of all the geometries one after the other
+    offsets.npy     int64 (n + 1), geometry i is coords[offsets[i]:offsets[i + 1]]
+    ann_id.npy      int64 (n), annotation id (-999 for the image bounds)
+    radius.npy      float64 (n), points only
+    misses.npy      int64 (n), polygons only, number of vertices that missed the model
+    label.npy, label_hier.npy, filename.npy
+                    int32 (n), codes in the categories of meta.json
+The arrays are memory-mapped on load, so filtering by label or reading the vertices does not
+materialize Python lists. Directories reprojected before this layout only hold points.pkl,
+lines.pkl and polygons.pkl DataFrames, load_reprojected falls back to them.
+"""
+import itertools
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+POINTS = 'points'
+LINES = 'lines'
+POLYGONS = 'polygons'
+
+CATEGORICAL_COLUMNS = ['label', 'label_hier', 'filename']
+COLUMN_DTYPES = {'ann_id': np.int64, 'radius': np.float64, 'misses': np.int64}
+
+# Columns of the legacy pickled DataFrames, also the rows produced by the reprojection
+POINT_COLUMNS = ['points', 'label', 'label_hier', 'filename', 'ann_id', 'radius']
+LINE_COLUMNS = ['points', 'label', 'label_hier', 'filename', 'ann_id']
+POLYGON_COLUMNS = ['points', 'label', 'label_hier', 'filename', 'ann_id', "misses"]
+KIND_COLUMNS = {POINTS: POINT_COLUMNS, LINES: LINE_COLUMNS, POLYGONS: POLYGON_COLUMNS}
+
+
+class ReprojectedGeometries:
+    """The reprojected geometries of one kind, as flat vertex coordinates, offsets and typed columns."""
+
+    def __init__(self, kind, coords, offsets, columns, categories):
+        self.kind = kind
+        self.coords = coords
+        self.offsets = offsets
+        self.columns = columns
+        self.categories = categories
+
+    @classmethod
+    def from_rows(cls, kind, rows):
+        """
+        Builds the geometries from reprojection rows ([vertices, label, label_hier, filename, ann_id, (radius | misses)]).
+
+        Args:
+            kind: POINTS, LINES or POLYGONS, point rows hold a single [x, y, z] vertex.
+            rows: The reprojected rows.
+        """
+        names = KIND_COLUMNS[kind][1:]
+        if kind == POINTS:
+            lengths = np.ones(len(rows), dtype=np.int64)
+            vertices = itertools.chain.from_iterable(row[0] for row in rows)
+        else:
+            lengths = np.array([len(row[0]) for row in rows], dtype=np.int64)
+            vertices = itertools.chain.from_iterable(itertools.chain.from_iterable(row[0]) for row in rows)
+        coords = np.fromiter(vertices, dtype=np.float64, count=3 * int(lengths.sum())).reshape(-1, 3)
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        values = {name: [row[i + 1] for row in rows] for i, name in enumerate(names)}
+        return cls._from_values(kind, coords, offsets, values)
+
+    @classmethod
+    def from_dataframe(cls, kind, dataframe):
+        """Builds the geometries from a legacy pickled DataFrame."""
+        return cls.from_rows(kind, dataframe[KIND_COLUMNS[kind]].values.tolist())
+
+    @classmethod
+    def _from_values(cls, kind, coords, offsets, values):
+        columns = {}
+        categories = {}
+        for name, column in values.items():
+            if name in CATEGORICAL_COLUMNS:
+                codes, uniques = pd.factorize(pd.Series(column, dtype=object), use_na_sentinel=False)
+                columns[name] = codes.astype(np.int32)
+                categories[name] = [None if pd.isna(x) else x for x in uniques.tolist()]
+            else:
+                columns[name] = np.asarray(column, dtype=COLUMN_DTYPES[name]).reshape(-1)
+        return cls(kind, coords, offsets, columns, categories)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Loads the geometries saved in directory path, memory-mapping the arrays."""
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+                  for name in ['coords', 'offsets'] + meta['columns']}
+        coords = arrays.pop('coords')
+        offsets = arrays.pop('offsets')
+        return cls(meta['kind'], coords, offsets, arrays, meta['categories'])
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'coords.npy'), np.ascontiguousarray(self.coords, dtype=np.float64))
+        np.save(os.path.join(path, 'offsets.npy'), np.ascontiguousarray(self.offsets, dtype=np.int64))
+        for name, column in self.columns.items():
+            np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(column))
+        # meta.json last, a directory without it is an incomplete write
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'version': 1, 'kind': self.kind, 'columns': list(self.columns.keys()),
+                       'categories': self.categories}, f)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        """Number of vertices of every geometry."""
+        return np.diff(self.offsets)
+
+    def geometry(self, i):
+        """The (n, 3) vertices of geometry i."""
+        return self.coords[self.offsets[i]:self.offsets[i + 1]]
+
+    def geometries(self):
+        """Iterates over the (n, 3) vertex arrays of the geometries."""
+        for start, end in zip(self.offsets[:-1], self.offsets[1:]):
+            yield self.coords[start:end]
+
+    def values(self, name):
+        """The values of a column, categorical columns decoded to an object array."""
+        column = self.columns[name]
+        if name in CATEGORICAL_COLUMNS:
+            return np.array(self.categories[name], dtype=object)[column]
+        return np.asarray(column)
+
+    def mask(self, name, value):
+        """Boolean mask of the geometries whose column equals value, without decoding categorical columns."""
+        column = np.asarray(self.columns[name])
+        if name in CATEGORICAL_COLUMNS:
+            if value not in self.categories[name]:
+                return np.zeros(len(self), dtype=bool)
+            return column == self.categories[name].index(value)
+        return column == value
+
+    def select(self, mask):
+        """
+        Subset of the geometries.
+
+        Args:
+            mask: Boolean mask or indices of the geometries to keep.
+
+        Returns:
+            ReprojectedGeometries: The selected geometries, in memory.
+        """
+        index = np.arange(len(self))[mask]
+        lengths = self.lengths[index]
+        vertex_index = np.repeat(self.offsets[:-1][index] - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+        vertex_index = vertex_index + np.arange(int(lengths.sum()))
+        columns = {name: np.asarray(column)[index] for name, column in self.columns.items()}
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        return ReprojectedGeometries(self.kind, np.asarray(self.coords)[vertex_index], offsets, columns,
+                                     self.categories)
+
+    def rows(self):
+        """The geometries as reprojection rows, as taken by export_reprojection."""
+        columns = [self.values(name).tolist() for name in KIND_COLUMNS[self.kind][1:]]
+        if self.kind == POINTS:
+            vertices = np.asarray(self.coords).tolist()
+        else:
+            vertices = [geometry.tolist() for geometry in self.geometries()]
+        return [list(row) for row in zip(vertices, *columns)]
+
+    def to_dataframe(self):
+        """The geometries as the legacy DataFrame (one row per geometry, vertices as lists)."""
+        return pd.DataFrame(self.rows(), columns=KIND_COLUMNS[self.kind])
+
+
+def save_reprojected(out_dir, point, line, polygon):
+    """Saves the reprojected point, line and polygon rows in the columnar layout of out_dir."""
+    for kind, rows in [(POINTS, point), (LINES, line), (POLYGONS, polygon)]:
+        ReprojectedGeometries.from_rows(kind, rows).save(os.path.join(out_dir, kind))
+
+
+def load_reprojected(ann_dir, kind):
+    """
+    Loads one geometry kind of a reprojected annotations directory.
+
+    Args:
+        ann_dir: The reprojected annotations directory.
+        kind: POINTS, LINES or POLYGONS.
+
+    Returns:
+        ReprojectedGeometries: The geometries, memory-mapped (converted in memory from legacy pickles).
+    """
+    path = os.path.join(ann_dir, kind)
+    if os.path.isfile(os.path.join(path, 'meta.json')):
+        return ReprojectedGeometries.load(path)
+    return ReprojectedGeometries.from_dataframe(kind, pd.read_pickle(os.path.join(ann_dir, kind + '.pkl')))
@@ -1,51 +1,78 @@
 import cv2
 import numpy as np
-import itertools
+
+# Pixel offsets looked at around an off-mesh contour point, in search order: by increasing
+# square radius (1 to 3), then row by row
+_SEARCH_OFFSETS = [(i, j) for radius in range(1, 4) for i in range(-radius, radius + 1) for j in range(-radius, radius + 1)]
+_SEARCH_OFFSETS = np.array(sorted(set(_SEARCH_OFFSETS), key=_SEARCH_OFFSETS.index))
+
+
+def footprint_mask(hit_map):
+    """W x H boolean mask of the pixels that hit the model, hit_map being a dense hit map or already a mask."""
+    hit_map = np.asarray(hit_map)
+    if hit_map.ndim == 2:
+        return hit_map.astype(bool)
+    return np.any(hit_map != 0, axis=2)
+
 
 def find_contour(hit_map):
-    width = hit_map.shape[0]
-    height = hit_map.shape[1]
-
-    hm_array = hit_map.copy()
-    for a in range(hm_array.shape[0]):
-        for b in range(hm_array.shape[1]):
-            if not np.array_equal(hm_array[a][b], np.array([0, 0, 0])):
-                hm_array[a][b] = np.array([255, 255, 255])
-    hm_array = hm_array.astype(np.uint8)
-    img = np.rot90(hm_array)  #Transform to horizontal image
-    img = np.pad(img, pad_width=((10, 10), (10, 10), (0, 0)))
+    """
+    Finds the footprint of an image on the model.
+
+    Args:
+        hit_map: The W x H x 3 dense hit map, or its W x H valid-pixel mask.
+
+    Returns:
+        list: The flat [x0, y0, x1, y1, ...] closed contour, in annotation coordinates (y-axis inverted).
+    """
+    mask = footprint_mask(hit_map)
+    width, height = mask.shape
+
+    img = np.rot90(mask).astype(np.uint8) * 255  # Transform to horizontal image
+    img = np.pad(img, pad_width=((10, 10), (10, 10)))
 
     edged = cv2.Canny(img, 30, 200)
     contours, hierarchy = cv2.findContours(edged, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    if len(contours) == 0:
+        return []
+
+    contour = max(contours, key=len).reshape(-1, 2)
+    contour = np.vstack((contour, contour[:1]))
+    # Remove padding and inverse y-axis
+    x = contour[:, 0] - 10
+    y = height - (contour[:, 1] - 10)
+    # If contour slightly off image, get back on it
+    x = np.clip(x, 0, width - 1)
+    y = np.clip(y, 0, height - 1)
+    # If contour slightly offset, get the closest point that's hit
+    x, y = search_around(x, y, mask)
+
+    # Convert to annotation format (y-axis inverted)
+    return np.column_stack((x, height - y)).ravel().tolist()
+
+
+def search_around(x, y, mask):
+    """
+    Moves the points that are not on the model to the first hit pixel found around them.
+
+    Args:
+        x, y: The integer pixel coordinates of the points.
+        mask: The W x H valid-pixel mask.
 
-    longest_contour = max(contours, key=len)
-
-    contour = list(itertools.chain(*longest_contour.tolist()))
-    contour.append(contour[0])
-    count = 0
-    for i in range(len(contour)):
-        # Remove padding and inverse y-axis
-        coord_point_contour = [contour[i][0] - 10, height - (contour[i][1] - 10)]
-        # If contour slightly off image, get back on it
-        coord_point_contour = [max(min(coord_point_contour[0], width - 1), 0), max(min(coord_point_contour[1], height - 1), 0)]
-        # If contour slightly offset, get the closest point that's hit
-        if np.array_equal(hit_map[coord_point_contour[0]][coord_point_contour[1]], [0,0,0]):
-            coord_point_contour, hit = search_around(coord_point_contour, hit_map)
-            if not hit:
-                count += 1
-
-        # Convert to annotation format (y-axis inverted)
-        contour[i] = [coord_point_contour[0], hit_map.shape[1] - coord_point_contour[1]]
-    return list(itertools.chain(*contour))
-
-
-def search_around(point, hm):
-    for radius in range(1, 4):
-        for i in range(-radius, radius + 1):
-            for j in range(-radius, radius + 1):
-                x = point[0]+i
-                y = point[1]+j
-                if 0 <= x < hm.shape[0] and 0 <= y < hm.shape[1]:
-                    if not np.array_equal(hm[x][y], [0,0,0]):
-                        return [x, y], True
-    return point, False
\ No newline at end of file
+    Returns:
+        tuple: The new x and y coordinates, points with no hit pixel within 3 pixels are left unchanged.
+    """
+    x, y = x.copy(), y.copy()
+    miss = np.flatnonzero(~mask[x, y])
+    if len(miss) == 0:
+        return x, y
+    cand_x = x[miss, None] + _SEARCH_OFFSETS[:, 0]
+    cand_y = y[miss, None] + _SEARCH_OFFSETS[:, 1]
+    inside = (0 <= cand_x) & (cand_x < mask.shape[0]) & (0 <= cand_y) & (cand_y < mask.shape[1])
+    hit = np.zeros(cand_x.shape, dtype=bool)
+    hit[inside] = mask[cand_x[inside], cand_y[inside]]
+    found = hit.any(axis=1)
+    first = hit.argmax(axis=1)
+    x[miss[found]] = cand_x[found, first[found]]
+    y[miss[found]] = cand_y[found, first[found]]
+    return x, y
@@ -0,0 +1,230 @@
+"""
+Parallel hit-map generation.
+
+The mesh is loaded once by the parent process and its vertex and face arrays are published
+through shared memory. Each worker process attaches to them, builds its ray intersector once
+and then ray-casts every camera it receives, writing the hit map straight to disk.
+
+Every completed hit map is appended to a manifest with a hash of the mesh file, the camera pose
+and intrinsics and the hit map format. Cameras whose hash is unchanged are skipped, so an
+interrupted run resumes where it stopped and adding cameras only computes the new ones.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+import trimesh
+
+import camera
+from utility import attach_array, share_array
+from reprojection.rays import camera_rays, pixel_rays
+from reprojection.hit_maps import SparseHitMap
+from reprojection.hit_map_io import (
+    HIT_MAP_COMPACT, HIT_MAP_DENSE, compute_footprint, footprint_path, load_hit_map, save_compact_hit_map,
+    save_footprint,
+)
+
+# Per-process state of a pool worker (shared memory handles and ray intersector)
+_worker = {}
+
+
+class SharedMesh:
+    """Vertex and face arrays of a trimesh published in shared memory for the lifetime of a `with` block."""
+
+    def __init__(self, mesh):
+        self._vertices_shm, vertices_desc = share_array(mesh.vertices)
+        self._faces_shm, faces_desc = share_array(mesh.faces)
+        self.descriptors = (vertices_desc, faces_desc)
+
+    def close(self):
+        for shm in [self._vertices_shm, self._faces_shm]:
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def init_worker(vertices_desc, faces_desc):
+    """Pool initializer: attach to the shared mesh and build the ray intersector once per worker."""
+    vertices_shm, vertices = attach_array(vertices_desc)
+    faces_shm, faces = attach_array(faces_desc)
+    mesh = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+    _worker['shm'] = [vertices_shm, faces_shm]
+    _worker['intersector'] = trimesh.ray.ray_pyembree.RayMeshIntersector(mesh)
+
+
+def cast_camera(intersector, trsf_matrix, fov, res):
+    """
+    Ray-casts every pixel of one camera against the mesh.
+
+    Args:
+        intersector: The trimesh RayMeshIntersector of the mesh.
+        trsf_matrix: The 4x4 camera to world matrix.
+        fov: The (x, y) field of view in radians.
+        res: The (width, height) resolution in pixels.
+
+    Returns:
+        tuple: The hit points, the (x, y) pixels that hit and the depth of each hit along its ray.
+    """
+    origins, vectors, pixels = camera_rays(trsf_matrix, fov, res)
+    points, index_ray, index_tri = intersector.intersects_location(origins, vectors, multiple_hits=False)
+    depth = np.einsum('ij,ij->i', points - origins[index_ray], vectors[index_ray])
+    return points, pixels[index_ray], depth
+
+
+def convert_to_hit_map(intersector, trsf_matrix, fov, res):
+    """
+    Ray-casts one camera against the mesh.
+
+    Args:
+        intersector: The trimesh RayMeshIntersector of the mesh.
+        trsf_matrix: The 4x4 camera to world matrix.
+        fov: The (x, y) field of view in radians.
+        res: The (width, height) resolution in pixels.
+
+    Returns:
+        numpy.ndarray: The W x H x 3 float16 hit map, zero where no face was hit.
+    """
+    points, pixel_ray, depth = cast_camera(intersector, trsf_matrix, fov, res)
+    a = np.zeros(np.append(res, 3), dtype=np.float16)
+    a[pixel_ray[:, 0], pixel_ray[:, 1]] = points
+    return a
+
+
+def camera_tasks(cams, export, hit_map_format=HIT_MAP_DENSE):
+    """
+    Builds the picklable hit-map jobs for a list of cameras.
+
+    Args:
+        cams: The cameras parsed from the sfm file.
+        export: The hit maps output directory.
+        hit_map_format: HIT_MAP_DENSE (float16 .npy, the default) or HIT_MAP_COMPACT (.npz depth maps).
+
+    Returns:
+        list: One (export_path, trsf_matrix, fov, res, hit_map_format) tuple per camera.
+    """
+    tasks = []
+    for cam in cams:
+        trsf_matrix, fov, shift, focal_length, res, dist = camera.get_cam_parameters(cam)
+        tasks.append((os.path.join(export, cam.get_relative_fp()), trsf_matrix, fov, res, hit_map_format))
+    return tasks
+
+
+def hit_map_task(task):
+    """Pool worker: computes and saves the hit map of one camera and its footprint sidecar, returns the task export path and the hit map path."""
+    export_path, trsf_matrix, fov, res, hit_map_format = task
+    if hit_map_format == HIT_MAP_COMPACT:
+        points, pixels, depth = cast_camera(_worker['intersector'], trsf_matrix, fov, res)
+        hit_map_path = save_compact_hit_map(export_path, pixels, depth, trsf_matrix, fov, res)
+        hit_map = load_hit_map(hit_map_path)
+    else:
+        hit_map = convert_to_hit_map(_worker['intersector'], trsf_matrix, fov, res)
+        hit_map_path = export_path + '.npy'
+        np.save(hit_map_path, hit_map)
+    save_footprint(hit_map_path, compute_footprint(hit_map))
+    # Remove a hit map of the same camera previously saved in the other format
+    for stale_path in [export_path + '.npy', export_path + '.npz']:
+        if stale_path != hit_map_path and os.path.isfile(stale_path):
+            os.remove(stale_path)
+    return export_path, hit_map_path
+
+
+MANIFEST_NAME = 'hit_maps_manifest.jsonl'
+
+
+def task_hash(mesh_digest, task):
+    """Hash of everything a hit map depends on: mesh file, camera pose, intrinsics and hit map format."""
+    export_path, trsf_matrix, fov, res, hit_map_format = task
+    digest = hashlib.sha1(mesh_digest.encode())
+    digest.update(np.asarray(trsf_matrix, dtype=np.float64).tobytes())
+    digest.update(np.asarray(fov, dtype=np.float64).tobytes())
+    digest.update(np.asarray(res, dtype=np.int64).tobytes())
+    digest.update(hit_map_format.encode())
+    return digest.hexdigest()
+
+
+class HitMapManifest:
+    """Append-only record of the completed hit maps of a directory and of their hashes."""
+
+    def __init__(self, export):
+        self.path = os.path.join(export, MANIFEST_NAME)
+        self.entries = {}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:  # Line truncated by a crash
+                        continue
+                    self.entries[entry['export_path']] = entry
+
+    def is_up_to_date(self, export_path, hash_value):
+        entry = self.entries.get(export_path)
+        return (entry is not None and entry['hash'] == hash_value and os.path.isfile(entry['hit_map'])
+                and os.path.isfile(footprint_path(entry['hit_map'])))
+
+    def add(self, export_path, hit_map_path, hash_value):
+        entry = {'export_path': export_path, 'hit_map': hit_map_path, 'hash': hash_value}
+        self.entries[export_path] = entry
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+
+def pending_tasks(tasks, manifest, mesh_digest):
+    """
+    Filters out the tasks whose hit map is already up to date.
+
+    Returns:
+        tuple: The tasks still to compute and the {export_path: hash} of all the tasks.
+    """
+    hashes = {task[0]: task_hash(mesh_digest, task) for task in tasks}
+    return [task for task in tasks if not manifest.is_up_to_date(task[0], hashes[task[0]])], hashes
+
+
+def cast_pixels(intersector, jobs, batch_size=2000000):
+    """
+    Ray-casts selected pixels of many cameras, batching rays of consecutive cameras together.
+
+    Args:
+        intersector: The trimesh RayMeshIntersector of the mesh.
+        jobs: Iterable of (key, trsf_matrix, fov, res, pixels) tuples, pixels being (n, 2) int arrays.
+        batch_size: Approximate number of rays sent at once to the intersector.
+
+    Yields:
+        tuple: The job key and the SparseHitMap of its pixels.
+    """
+    batch = []
+    nb_rays = 0
+    for job in jobs:
+        batch.append(job)
+        nb_rays += len(job[4])
+        if nb_rays >= batch_size:
+            yield from _cast_batch(intersector, batch)
+            batch = []
+            nb_rays = 0
+    if batch:
+        yield from _cast_batch(intersector, batch)
+
+
+def _cast_batch(intersector, batch):
+    origins = []
+    vectors = []
+    for key, trsf_matrix, fov, res, pixels in batch:
+        o, v = pixel_rays(trsf_matrix, fov, res, pixels)
+        origins.append(o)
+        vectors.append(v)
+    offsets = np.cumsum([0] + [len(job[4]) for job in batch])
+    points = np.empty((0, 3))
+    index_ray = np.empty(0, dtype=np.int64)
+    if offsets[-1] != 0:
+        points, index_ray, index_tri = intersector.intersects_location(
+            np.concatenate(origins), np.concatenate(vectors), multiple_hits=False)
+    job_of_ray = np.searchsorted(offsets, index_ray, side='right') - 1
+    for i, (key, trsf_matrix, fov, res, pixels) in enumerate(batch):
+        hit = job_of_ray == i
+        yield key, SparseHitMap(res, pixels[index_ray[hit] - offsets[i]], points[hit])
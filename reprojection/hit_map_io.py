@@ -0,0 +1,142 @@
+"""
+Hit map files.
+
+Two formats live side by side in a hit maps directory:
+    - dense (legacy): `<image>.npy`, the W x H x 3 float16 XYZ of every pixel.
+    - compact: `<image>.npz`, the packed valid-pixel mask and the depth of every hit along its
+      ray, quantized on 16 bits between the minimal and maximal depth of the image, together
+      with the camera pose and field of view. XYZ is rebuilt on read, so the precision only
+      depends on the depth range of the image and not on the distance to the model origin.
+
+Each hit map has a `<image>.footprint.npz` sidecar computed at generation time, holding the
+image footprint contour, the packed valid-pixel mask and coverage statistics.
+"""
+import numpy as np
+
+from reprojection.hit_maps import CompactHitMap
+from reprojection.contour_finding import find_contour, footprint_mask
+
+HIT_MAP_DENSE = 'dense'
+HIT_MAP_COMPACT = 'compact'
+HIT_MAP_EXTENSIONS = ('.npy', '.npz')
+FOOTPRINT_SUFFIX = '.footprint.npz'
+
+DEPTH_LEVELS = np.iinfo(np.uint16).max
+
+
+def save_compact_hit_map(export_path, pixels, depth, trsf_matrix, fov, res):
+    """
+    Saves a hit map in the compact format.
+
+    Args:
+        export_path: The hit map path, without extension.
+        pixels: The (n, 2) integer (x, y) pixels that hit the model.
+        depth: The depth of each hit along its ray.
+        trsf_matrix: The 4x4 camera to world matrix.
+        fov: The (x, y) field of view in radians.
+        res: The (width, height) resolution in pixels.
+
+    Returns:
+        str: The path of the saved file.
+    """
+    res = tuple(int(x) for x in res)
+    depth_img = np.zeros(res)
+    depth_img[pixels[:, 0], pixels[:, 1]] = depth
+    mask = np.zeros(res, dtype=bool)
+    mask[pixels[:, 0], pixels[:, 1]] = True
+    depth = depth_img[mask]
+
+    depth_offset = depth.min() if len(depth) != 0 else 0.
+    depth_scale = (depth.max() - depth_offset) / DEPTH_LEVELS if len(depth) != 0 else 0.
+    if depth_scale == 0:
+        depth_scale = 1.
+    quantized = np.round((depth - depth_offset) / depth_scale).astype(np.uint16)
+
+    hit_map_path = export_path + '.npz'
+    np.savez(hit_map_path, mask=np.packbits(mask), depth=quantized, depth_offset=depth_offset,
+             depth_scale=depth_scale, res=np.asarray(res), trsf_matrix=trsf_matrix, fov=np.asarray(fov))
+    return hit_map_path
+
+
+def load_hit_map(hit_map_path):
+    """
+    Loads a hit map of any format.
+
+    Args:
+        hit_map_path: The path to the .npy or .npz hit map.
+
+    Returns:
+        The dense numpy array or a CompactHitMap, both indexed as hit_map[x, y].
+    """
+    if hit_map_path.endswith('.npz'):
+        with np.load(hit_map_path) as data:
+            res = tuple(int(x) for x in data['res'])
+            mask = np.unpackbits(data['mask'], count=res[0] * res[1]).reshape(res).astype(bool)
+            depth = data['depth_offset'] + data['depth'] * data['depth_scale']
+            return CompactHitMap.from_valid_depth(mask, depth, data['trsf_matrix'], data['fov'])
+    return np.load(hit_map_path)
+
+
+def is_hit_map_file(file_name):
+    return file_name.endswith(HIT_MAP_EXTENSIONS) and not file_name.endswith(FOOTPRINT_SUFFIX)
+
+
+def footprint_path(hit_map_path):
+    return hit_map_path.rsplit('.', maxsplit=1)[0] + FOOTPRINT_SUFFIX
+
+
+def hit_map_mask(hit_map):
+    """W x H boolean mask of the pixels of a hit map (of any format) that hit the model."""
+    if isinstance(hit_map, CompactHitMap):
+        return hit_map.mask
+    return footprint_mask(hit_map)
+
+
+def compute_footprint(hit_map):
+    """
+    Computes the footprint of a hit map.
+
+    Args:
+        hit_map: The dense array or CompactHitMap.
+
+    Returns:
+        dict: The contour (flat annotation coordinates, as find_contour), the valid-pixel mask,
+        the number of valid pixels and the coverage ratio of the image.
+    """
+    mask = hit_map_mask(hit_map)
+    valid_pixels = int(mask.sum())
+    return {
+        'contour': find_contour(mask),
+        'mask': mask,
+        'valid_pixels': valid_pixels,
+        'coverage': valid_pixels / mask.size,
+    }
+
+
+def save_footprint(hit_map_path, footprint):
+    path = footprint_path(hit_map_path)
+    np.savez(path, contour=np.asarray(footprint['contour'], dtype=np.int32),
+             mask=np.packbits(footprint['mask']), res=np.asarray(footprint['mask'].shape),
+             valid_pixels=footprint['valid_pixels'], coverage=footprint['coverage'])
+    return path
+
+
+def load_footprint(hit_map_path):
+    """
+    Loads the footprint sidecar of a hit map.
+
+    Returns:
+        dict: As compute_footprint, or None if the hit map has no sidecar.
+    """
+    try:
+        data = np.load(footprint_path(hit_map_path))
+    except FileNotFoundError:
+        return None
+    with data:
+        res = tuple(int(x) for x in data['res'])
+        return {
+            'contour': data['contour'].tolist(),
+            'mask': np.unpackbits(data['mask'], count=res[0] * res[1]).reshape(res).astype(bool),
+            'valid_pixels': int(data['valid_pixels']),
+            'coverage': float(data['coverage']),
+        }
@@ -0,0 +1,179 @@
+"""
+Single-file hit map store.
+
+All the hit maps of a model are packed in one binary file (`<name>.hms`), every hit map being
+a page-aligned chunk, described by an index table keyed by image name (`<name>.hms.json`).
+The data file is memory-mapped once: a hit map is a view on the mapping, so accessing one
+pixel of one image only reads the pages it touches, and several readers (reprojection, viewer,
+statistics) share the same pages without copying them.
+
+Dense hit maps are stored as their W x H x 3 float16 XYZ, compact ones as their W x H float32
+depth map (NaN where the ray missed) together with the camera pose. The footprint contour and
+coverage statistics of every hit map are kept in the index.
+
+Convert an existing hit maps directory with:
+    python -m reprojection.hit_map_store <hit_maps_dir> <store.hms>
+"""
+import json
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from reprojection.hit_maps import CompactHitMap
+from reprojection.hit_map_io import (
+    HIT_MAP_COMPACT, HIT_MAP_DENSE, compute_footprint, is_hit_map_file, load_footprint, load_hit_map,
+)
+
+HIT_MAP_STORE_EXTENSION = '.hms'
+CHUNK_ALIGNMENT = 4096
+
+
+def is_hit_map_store(path):
+    return path is not None and path.endswith(HIT_MAP_STORE_EXTENSION)
+
+
+def _image_datetime(image_name):
+    str_dt = image_name.rsplit('.', maxsplit=1)[0]
+    try:
+        return datetime.strptime(str_dt, "%Y%m%dT%H%M%S.%fZ").isoformat()
+    except ValueError:
+        return None
+
+
+class HitMapStore:
+    """Memory-mapped hit map store, hit_map = store[image_name]."""
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(store_path + '.json', 'r') as f:
+            self.index = json.load(f)['entries']
+        # An empty file cannot be memory-mapped, a store without data is read as an empty buffer
+        self._data = np.zeros(0, dtype=np.uint8)
+        if os.path.getsize(store_path) != 0:
+            self._data = np.memmap(store_path, dtype=np.uint8, mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, image_name):
+        return image_name in self.index
+
+    def names(self):
+        return list(self.index.keys())
+
+    def __getitem__(self, image_name):
+        entry = self.index[image_name]
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if entry['offset'] + nbytes > len(self._data):  # Truncated store
+            raise KeyError(image_name)
+        array = self._data[entry['offset']:entry['offset'] + nbytes].view(dtype).reshape(shape)
+        if entry['kind'] == HIT_MAP_COMPACT:
+            return CompactHitMap(array, np.asarray(entry['trsf_matrix']), np.asarray(entry['fov']))
+        return array
+
+    def footprint(self, image_name):
+        """The footprint contour and coverage statistics of a stored hit map, None if unknown."""
+        entry = self.index[image_name]
+        if 'contour' not in entry:
+            return None
+        return {'contour': entry['contour'], 'valid_pixels': entry['valid_pixels'], 'coverage': entry['coverage']}
+
+    def cameras(self):
+        """
+        The camera table of the stored images, as returned by reproject.get_reproj_cameras.
+
+        Returns:
+            pandas.DataFrame: The datetime, hit map key ('hm') and image name of every stored image.
+        """
+        names = self.names()
+        cam_df = pd.DataFrame({
+            'datetime': pd.to_datetime([self.index[name]['datetime'] for name in names]),
+            'hm': names,
+        }, index=names)
+        cam_df['image_name'] = cam_df.index
+        return cam_df
+
+
+class HitMapStoreWriter:
+    """Appends hit maps to a new store, the index is written on close."""
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.entries = {}
+        self._file = open(store_path, 'wb')
+
+    def add(self, image_name, hit_map, footprint=None):
+        if isinstance(hit_map, CompactHitMap):
+            array = np.ascontiguousarray(hit_map.depth, dtype=np.float32)
+            entry = {
+                'kind': HIT_MAP_COMPACT,
+                'trsf_matrix': np.asarray(hit_map.trsf_matrix).tolist(),
+                'fov': np.asarray(hit_map.fov).tolist(),
+            }
+        else:
+            array = np.ascontiguousarray(hit_map)
+            entry = {'kind': HIT_MAP_DENSE}
+
+        offset = self._file.tell()
+        padding = -offset % CHUNK_ALIGNMENT
+        self._file.write(b'\0' * padding)
+        entry.update({
+            'offset': offset + padding,
+            'shape': list(array.shape),
+            'dtype': array.dtype.str,
+            'datetime': _image_datetime(image_name),
+        })
+        if footprint is not None:
+            entry.update({
+                'contour': [int(x) for x in footprint['contour']],
+                'valid_pixels': footprint['valid_pixels'],
+                'coverage': footprint['coverage'],
+            })
+        self._file.write(array.tobytes())
+        self.entries[image_name] = entry
+
+    def close(self):
+        self._file.close()
+        tmp_path = self.store_path + '.json.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 1, 'entries': self.entries}, f)
+        os.replace(tmp_path, self.store_path + '.json')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def convert_hit_maps_dir(hit_maps_dir, store_path):
+    """
+    Packs a directory of .npy / .npz hit maps into a single store.
+
+    Args:
+        hit_maps_dir: The hit maps directory.
+        store_path: The path of the store to create (.hms).
+
+    Returns:
+        str: The store path.
+    """
+    with HitMapStoreWriter(store_path) as writer:
+        for hm in sorted(os.listdir(hit_maps_dir)):
+            if is_hit_map_file(hm):
+                image_name = hm.rsplit('.', maxsplit=1)[0]
+                hm_path = os.path.join(hit_maps_dir, hm)
+                hit_map = load_hit_map(hm_path)
+                footprint = load_footprint(hm_path)
+                if footprint is None:
+                    footprint = compute_footprint(hit_map)
+                writer.add(image_name, hit_map, footprint)
+    return store_path
+
+
+if __name__ == "__main__":
+    convert_hit_maps_dir(sys.argv[1], sys.argv[2])
@@ -0,0 +1,84 @@
+"""
+In-memory hit map representations.
+
+All of them are indexed like the dense W x H x 3 arrays written by the hit-map generation,
+`hit_map[x, y]` returning the 3D location seen by pixel (x, y) (y axis pointing up), or zeros
+if the ray of this pixel missed the model.
+"""
+import numpy as np
+
+from reprojection.rays import camera_rays, pixel_rays
+
+
+class SparseHitMap:
+    """Hit points of a few pixels of one image, obtained by direct ray casting."""
+
+    def __init__(self, res, pixels, points):
+        """
+        Args:
+            res: The (width, height) resolution of the image.
+            pixels: The (n, 2) integer (x, y) coordinates of the pixels that hit the model.
+            points: The (n, 3) corresponding 3D locations.
+        """
+        self.shape = (int(res[0]), int(res[1]), 3)
+        keys = np.asarray(pixels, dtype=np.int64).reshape(-1, 2)
+        keys = keys[:, 0] * self.shape[1] + keys[:, 1]
+        order = np.argsort(keys)
+        self._keys = keys[order]
+        self._points = np.asarray(points, dtype=float).reshape(-1, 3)[order]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, key):
+        x, y = key
+        keys = np.asarray(x, dtype=np.int64) * self.shape[1] + np.asarray(y, dtype=np.int64)
+        if len(self._keys) == 0:
+            return np.zeros(np.shape(keys) + (3,))
+        pos = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+        found = self._keys[pos] == keys
+        return np.where(found[..., None], self._points[pos], 0)
+
+
+class CompactHitMap:
+    """Hit map stored as the depth of each hit along its pixel ray, NaN where the ray missed the model."""
+
+    def __init__(self, depth, trsf_matrix, fov):
+        """
+        Args:
+            depth: The W x H float depth map, possibly a read-only memory-mapped view.
+            trsf_matrix: The 4x4 camera to world matrix.
+            fov: The (x, y) field of view in radians.
+        """
+        self.depth = depth
+        self.shape = depth.shape + (3,)
+        self.trsf_matrix = trsf_matrix
+        self.fov = fov
+
+    @classmethod
+    def from_valid_depth(cls, mask, depth, trsf_matrix, fov):
+        """Builds the hit map from the valid-pixel mask and the depth of the valid pixels, in the C order of the mask."""
+        depth_map = np.full(mask.shape, np.nan, dtype=np.float32)
+        depth_map[mask] = depth
+        return cls(depth_map, trsf_matrix, fov)
+
+    @property
+    def mask(self):
+        return ~np.isnan(self.depth)
+
+    def __getitem__(self, key):
+        x, y = (np.asarray(i, dtype=np.int64) for i in key)
+        x_flat, y_flat = x.ravel(), y.ravel()
+        origins, vectors = pixel_rays(self.trsf_matrix, self.fov, self.shape[:2], np.column_stack((x_flat, y_flat)))
+        depth = self.depth[x_flat, y_flat]
+        xyz = origins + depth[:, None] * vectors
+        xyz[np.isnan(depth)] = 0
+        return xyz.reshape(x.shape + (3,))
+
+    def __array__(self, dtype=None, copy=None):
+        origins, vectors, pixels = camera_rays(self.trsf_matrix, self.fov, self.shape[:2])
+        depth = self.depth[pixels[:, 0], pixels[:, 1]]
+        xyz = np.zeros(self.shape, dtype=np.float32 if dtype is None else dtype)
+        xyz[pixels[:, 0], pixels[:, 1]] = origins + depth[:, None] * vectors
+        xyz[np.isnan(self.depth)] = 0
+        return xyz
@@ -0,0 +1,140 @@
+"""
+Point-in-volume test of reprojected polygon imprints, without building VTK volumes.
+
+The volume of an imprint is the one volume_filter used to build with VTK: the imprint vertices
+triangulated in their best fitting plane (pyvista delaunay_2d), translated by minus the mean
+cell normal v and extruded by 4 v. A point q is inside if q - t v lies on one of the triangles for some t in
+[-1, 3]. This is solved for all the candidate points of a triangle at once, candidates being
+the cloud points in the bounding box of the prism, read from the spatial index of the cloud
+(see geomorphometrics.cloud_index).
+"""
+import numpy as np
+from scipy.spatial import Delaunay
+
+EXTRUDE_BELOW = 1
+EXTRUDE_ABOVE = 3
+DELAUNAY_OFFSET = 1.0
+
+
+def _best_fitting_plane_rotation(vertices):
+    """
+    Rotation bringing the (a, b, -1) normal of the z = a x + b y + c least squares plane of the
+    vertices onto the z axis (vtkDelaunay2D best fitting plane projection).
+    """
+    centered = vertices - vertices.mean(axis=0)
+    (a, b), *_ = np.linalg.lstsq(centered[:, :2], centered[:, 2], rcond=None)
+    normal = np.array([a, b, -1.0]) / np.linalg.norm([a, b, -1.0])
+    axis = np.cross(normal, [0.0, 0.0, 1.0])
+    if np.linalg.norm(axis) == 0:  # Horizontal plane, the (0, 0, -1) normal is turned upside down
+        return np.diag([1.0, -1.0, -1.0])
+    axis /= np.linalg.norm(axis)
+    angle = np.arccos(np.clip(normal[2], -1, 1))
+    k = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+    return np.eye(3) + np.sin(angle) * k + (1 - np.cos(angle)) * k @ k
+
+
+def delaunay_2d(vertices):
+    """
+    Triangulates points as pyvista delaunay_2d does: Delaunay triangulation in the best fitting
+    plane, seeded with a bounding octagon whose triangles are then removed (this drops the thin
+    triangles along the convex hull).
+
+    Args:
+        vertices: The (n, 3) points.
+
+    Returns:
+        numpy.ndarray: The (m, 3) vertex indices of the triangles, counterclockwise around the
+        (a, b, -1) normal of the z = a x + b y + c best fitting plane.
+    """
+    if len(vertices) < 3:
+        return np.empty((0, 3), dtype=np.int64)
+    rotation = _best_fitting_plane_rotation(vertices)
+    projected = (vertices - vertices.mean(axis=0)) @ rotation.T
+    center = (projected.min(axis=0) + projected.max(axis=0)) / 2
+    radius = DELAUNAY_OFFSET * np.linalg.norm(vertices.max(axis=0) - vertices.min(axis=0))
+    angles = np.arange(8) * np.pi / 4
+    bounding = center[:2] + radius * np.column_stack((np.cos(angles), np.sin(angles)))
+    try:
+        simplices = Delaunay(np.concatenate([projected[:, :2], bounding])).simplices
+        simplices = simplices[np.all(simplices < len(vertices), axis=1)]
+        if len(simplices) == 0:  # A single sliver triangle, kept by delaunay_2d
+            simplices = Delaunay(projected[:, :2]).simplices
+    except (RuntimeError, ValueError):  # QhullError (degenerate input) is a RuntimeError
+        return np.empty((0, 3), dtype=np.int64)
+    # Counterclockwise in the projection plane
+    a, b, c = (projected[simplices[:, i], :2] for i in range(3))
+    clockwise = (b - a)[:, 0] * (c - a)[:, 1] - (b - a)[:, 1] * (c - a)[:, 0] < 0
+    simplices[clockwise] = simplices[clockwise][:, [0, 2, 1]]
+    return simplices
+
+
+class ImprintPrism:
+    """The extruded volume of one reprojected polygon."""
+
+    def __init__(self, vertices):
+        """
+        Args:
+            vertices: The (n, 3) reprojected polygon vertices.
+        """
+        self.vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+        self.triangles = np.empty((0, 3, 3))
+        self.normal = np.zeros(3)
+        if len(self.vertices) < 3:
+            return
+        simplices = delaunay_2d(self.vertices)
+        if len(simplices) == 0:  # All vertices aligned
+            return
+        triangles = self.vertices[simplices]
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        norms = np.linalg.norm(normals, axis=1)
+        valid = norms > 0
+        if not valid.any():
+            return
+        # The mean of the cell normals is the extrusion vector. It points downwards (see
+        # delaunay_2d): the prism goes from 1 |v| above the imprint to 3 |v| below it
+        normals = normals[valid] / norms[valid, None]
+        self.triangles = triangles[valid]
+        self.normal = normals.mean(axis=0)
+
+    def bounds(self):
+        """The (min, max) corners of the prism bounding box."""
+        if len(self.triangles) == 0:
+            return np.full(3, np.inf), np.full(3, -np.inf)
+        corners = np.concatenate([self.vertices - EXTRUDE_BELOW * self.normal,
+                                  self.vertices + EXTRUDE_ABOVE * self.normal])
+        return corners.min(axis=0), corners.max(axis=0)
+
+    def contains(self, points):
+        """
+        Args:
+            points: The (k, 3) points to test.
+
+        Returns:
+            numpy.ndarray: The (k,) mask of the points inside the prism.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        inside = np.zeros(len(points), dtype=bool)
+        for a, b, c in self.triangles:
+            # q = a + beta (b - a) + gamma (c - a) + t v
+            m = np.column_stack((b - a, c - a, self.normal))
+            if abs(np.linalg.det(m)) < 1e-12:  # Triangle parallel to the extrusion
+                continue
+            todo = ~inside
+            beta, gamma, t = np.linalg.solve(m, (points[todo] - a).T)
+            inside[todo] = ((beta >= 0) & (gamma >= 0) & (beta + gamma <= 1)
+                            & (t >= -EXTRUDE_BELOW) & (t <= EXTRUDE_ABOVE))
+        return inside
+
+
+def points_in_prism(index, prism):
+    """
+    Args:
+        index: The spatial index of the point cloud (CloudGridIndex).
+        prism: The ImprintPrism.
+
+    Returns:
+        numpy.ndarray: The sorted indices of the cloud points inside the prism.
+    """
+    candidates = index.box(*prism.bounds())
+    inside = candidates[prism.contains(index.points[candidates])]
+    return np.sort(inside)
@@ -0,0 +1,67 @@
+"""
+Camera rays, one per pixel, as used to ray-cast hit maps.
+
+Pixels are indexed (x, y) with the y axis pointing up, as in the hit maps.
+"""
+from functools import lru_cache
+
+import numpy as np
+import trimesh
+from trimesh import transformations
+
+
+@lru_cache(maxsize=8)
+def _camera_frame_rays(res, fov):
+    # Rays only depend on the intrinsics in the camera frame, so they are shared by all the poses
+    cam = trimesh.scene.Camera(resolution=res, fov=fov)
+    return trimesh.scene.cameras.camera_to_rays(cam)
+
+
+def camera_rays(trsf_matrix, fov, res):
+    """
+    Same rays as trimesh.Scene.camera_rays, one per pixel, without rebuilding them for every pose.
+
+    Args:
+        trsf_matrix: The 4x4 camera to world matrix.
+        fov: The (x, y) field of view in radians.
+        res: The (width, height) resolution in pixels.
+
+    Returns:
+        tuple: Ray origins, unit direction vectors and corresponding (x, y) pixels.
+    """
+    vectors, pixels = _camera_frame_rays(tuple(int(x) for x in res), tuple(float(x) for x in np.rad2deg(fov)))
+    vectors = transformations.transform_points(vectors, trsf_matrix, translate=False)
+    origins = np.ones_like(vectors) * transformations.translation_from_matrix(trsf_matrix)
+    return origins, vectors, pixels
+
+
+@lru_cache(maxsize=8)
+def _camera_frame_ray_index(res, fov):
+    # (x, y) pixel -> row of the camera frame rays
+    vectors, pixels = _camera_frame_rays(res, fov)
+    index = np.empty(res, dtype=np.int64)
+    index[pixels[:, 0], pixels[:, 1]] = np.arange(len(pixels))
+    return index
+
+
+def pixel_rays(trsf_matrix, fov, res, pixels):
+    """
+    Rays of a subset of pixels, identical to the corresponding rows of camera_rays.
+
+    Args:
+        trsf_matrix: The 4x4 camera to world matrix.
+        fov: The (x, y) field of view in radians.
+        res: The (width, height) resolution in pixels.
+        pixels: The (n, 2) integer (x, y) hit-map pixel coordinates.
+
+    Returns:
+        tuple: Ray origins and unit direction vectors.
+    """
+    res = tuple(int(x) for x in res)
+    fov = tuple(float(x) for x in np.rad2deg(fov))
+    vectors, _ = _camera_frame_rays(res, fov)
+    index = _camera_frame_ray_index(res, fov)
+    vectors = vectors[index[pixels[:, 0], pixels[:, 1]]]
+    vectors = transformations.transform_points(vectors, trsf_matrix, translate=False)
+    origins = np.ones_like(vectors) * transformations.translation_from_matrix(trsf_matrix)
+    return origins, vectors
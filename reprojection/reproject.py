@@ -1,26 +1,34 @@
 import camera
 from openmvg_json_file_handler import OpenMVGJSONFileHandler
 import pyembree
+from reprojection import hit_map_engine
+from reprojection.hit_map_io import HIT_MAP_DENSE, is_hit_map_file
+from reprojection.hit_map_store import HitMapStore, convert_hit_maps_dir, is_hit_map_store
+from reprojection import reproject_kernel
 from reprojection.contour_finding import find_contour
-import itertools
+from reprojection.reprojection_writer import ReprojectionWriter
 import numpy as np
 import trimesh
 import os
+import multiprocessing as mp
+import queue
+import threading
 import video_annotations
-import ast
+from annotation_reports import load_report
 import utility
-from math import dist
 import pandas as pd
 from tqdm import tqdm
 from datetime import datetime
 from PyQt5 import QtCore
 
+FOOTPRINT_STEP = 16
+
 
 def get_reproj_cameras(hit_maps_dir):
     hit_maps = os.listdir(hit_maps_dir)
     cam_list = {}
     for hm in hit_maps:
-        if hm.endswith('.npy'):
+        if is_hit_map_file(hm):
             hm_path = os.path.join(hit_maps_dir, hm)
             img = hm.rsplit('.', maxsplit=1)[0]
             str_dt = img.rsplit('.', maxsplit=1)[0]
@@ -31,188 +39,310 @@ def get_reproj_cameras(hit_maps_dir):
     return cam_df
 
 
+def get_sfm_cameras(sfm_path):
+    """
+    Same camera table as get_reproj_cameras, built from the registered cameras of an sfm file
+    for the direct ray casting mode (no hit maps).
+    """
+    cams = OpenMVGJSONFileHandler.parse_openmvg_file(sfm_path, "NAME", True)
+    cam_list = {}
+    for cam in cams:
+        img = cam.get_relative_fp()
+        str_dt = img.rsplit('.', maxsplit=1)[0]
+        try:
+            date_object = datetime.strptime(str_dt, "%Y%m%dT%H%M%S.%fZ")
+        except ValueError:
+            date_object = pd.NaT
+        cam_list[img] = {"datetime": date_object, "cam": cam}
+    cam_df = pd.DataFrame.from_dict(cam_list, orient='index').sort_index()
+    cam_df['image_name'] = cam_df.index
+    return cam_df
+
+
+def annotation_coords(shape_name, points):
+    """Annotation space (x, y) coordinates looked up by annotationTo3D.reproject for one annotation."""
+    if shape_name == 'Circle':
+        x, y, r = points[:3]
+        return [(x, y), (x + r, y), (x - r, y), (x, y + r), (x, y - r)]
+    elif shape_name == 'Point':
+        return [tuple(points[:2])]
+    elif shape_name in ['LineString', 'Polygon', 'Rectangle']:
+        return list(zip(*[iter(points)] * 2))
+    return []
+
+
+def annotation_pixels(coords, res):
+    """
+    Converts annotation space coordinates to hit map pixels, with the same bounds and y axis
+    inversion as reproject_kernel.lookup. Coordinates outside the image are dropped.
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    width, height = res
+    x, y = coords[:, 0], coords[:, 1]
+    valid = (0 <= x) & (x < width) & (0 <= y) & (y < height)
+    pixels = np.column_stack((x[valid], height - y[valid])).astype(np.int64)
+    return pixels[pixels[:, 1] < height]
+
+
+def footprint_grid(res, step=FOOTPRINT_STEP):
+    """
+    Hit map pixels of a coarse grid over the image, every `step` pixels, and their mirror along the y
+    axis, where the vertices of a contour traced on the grid are looked up (see reproject_kernel.lookup).
+    """
+    width, height = res
+    gx, gy = np.meshgrid(np.arange(0, width, step), np.arange(0, height, step), indexing='ij')
+    grid = np.column_stack((gx.ravel(), gy.ravel()))
+    mirror = np.column_stack((grid[:, 0], height - grid[:, 1]))
+    return np.concatenate([grid, mirror[mirror[:, 1] < height]]).astype(np.int64)
+
+
+def grid_footprint(hit_map, step=FOOTPRINT_STEP):
+    """
+    Footprint contour of a hit map cast on footprint_grid, traced by find_contour over the mask of the
+    grid and scaled back to the image, as find_contour over a full hit map.
+
+    Returns:
+        list: The flat [x0, y0, x1, y1, ...] closed contour.
+    """
+    width, height = hit_map.shape[:2]
+    gx, gy = np.meshgrid(np.arange(0, width, step), np.arange(0, height, step), indexing='ij')
+    mask = np.any(hit_map[gx, gy] != 0, axis=-1)
+    contour = np.asarray(find_contour(mask), dtype=np.int64).reshape(-1, 2) * step
+    return contour.ravel().tolist()
+
+
+def annotations_by_image(annotations):
+    """Index of the annotations by image, built once: {filename: annotations of that image}."""
+    return {image: ann_img for image, ann_img in annotations.groupby('filename', sort=False)}
+
+
+def prefetch(iterable, size=4):
+    """
+    Iterates over iterable in a background thread, keeping up to `size` items ready (e.g. hit maps read from disk).
+
+    The producer stops when the consumer does (the generator being closed), instead of waiting
+    forever for room in the queue.
+    """
+    items = queue.Queue(maxsize=size)
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(e)
+        put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while (item := items.get()) is not done:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
 class annotationTo3D():
-    def __init__(self, annotation_path: str, hit_maps_dir: str, report_type: bool, wholeframe_only: bool =  False, reprojected_annotations_dir: str = None):
+    def __init__(self, annotation_path: str, hit_maps_dir: str, report_type: bool, wholeframe_only: bool =  False, reprojected_annotations_dir: str = None, model: str = None, sfm: str = None, nb_processes: int = 1):
+        """
+        Without hit maps directory, annotations are reprojected by direct ray casting of their
+        pixels against the 3D model, with the registered cameras of the sfm file.
+        hit_maps_dir may also be a single-file hit map store (.hms).
+        With hit maps and nb_processes > 1, images are reprojected in parallel by a process pool.
+        """
         self.annotation_path = annotation_path
         self.hit_maps_dir = hit_maps_dir
         self.wholeframe_only = wholeframe_only
         self.report_type = report_type
         self.reprojected_annotations_dir = reprojected_annotations_dir
+        self.model = model
+        self.nb_processes = nb_processes
+        self.running = True
 
-        self.reproj_cameras = get_reproj_cameras(self.hit_maps_dir)
-
-        self.min_x = self.min_y = 0
-        self.max_x = 0
-        self.max_y = 0
+        self.hit_map_store = None
+        if self.hit_maps_dir is None:
+            self.reproj_cameras = get_sfm_cameras(sfm)
+        elif is_hit_map_store(self.hit_maps_dir):
+            self.hit_map_store = HitMapStore(self.hit_maps_dir)
+            self.reproj_cameras = self.hit_map_store.cameras()
+        else:
+            self.reproj_cameras = get_reproj_cameras(self.hit_maps_dir)
 
         self.min_radius = 0.01
 
-    def annotation2hitpoint(self, ann_coords, hit_map):
-        (x, y) = ann_coords
-        if self.min_x <= x < self.max_x and self.min_y <= y < self.max_y:
-            y = self.max_y - y  # Inverse Y axis
-            coord = hit_map[int(x)][int(y)]
-            if np.array_equal(coord, [0, 0, 0]):
-                return None
-            return coord
-        return None
-
     def get_hit_map(self, hit_map_path):
-        hit_map = np.load(hit_map_path)
-        self.max_x, self.max_y = hit_map.shape[:2]
-        contour = find_contour(hit_map)
-        return hit_map, contour
-
-    def reproject_annotations(self):
-        if self.report_type is not None:
+        return reproject_kernel.open_hit_map(hit_map_path, self.hit_map_store)
+
+    def cast_annotation_rays(self, annotations, cameras):
+        """
+        Ray-casts the pixels of every annotation and of a coarse grid over the image, in large batches.
+        The footprint contour is traced on the grid, its vertices that miss the model being counted
+        as for the hit maps.
+
+        Args:
+            annotations: The annotations DataFrame, with parsed points.
+            cameras: The camera table of the images to cast.
+
+        Yields:
+            tuple: The image name, its SparseHitMap and the image footprint contour.
+        """
+        mesh = trimesh.load(self.model)
+        intersector = trimesh.ray.ray_pyembree.RayMeshIntersector(mesh)
+
+        by_image = annotations_by_image(annotations)
+        empty = annotations.iloc[0:0]
+
+        def jobs():
+            for image, cam in cameras['cam'].items():
+                trsf_matrix, fov, shift, focal_length, res, dist = camera.get_cam_parameters(cam)
+                ann_img = by_image.get(image, empty)
+                coords = [c for shape_name, points in zip(ann_img['shape_name'], ann_img['points'])
+                          for c in annotation_coords(shape_name, points)]
+                pixels = np.concatenate([annotation_pixels(coords, res), footprint_grid(res)])
+                yield image, trsf_matrix, fov, res, np.unique(pixels, axis=0)
+
+        for image, hit_map in hit_map_engine.cast_pixels(intersector, jobs()):
+            yield image, hit_map, grid_footprint(hit_map)
+
+    def reproject_annotations(self, progress=None):
+        if self.report_type == "video":
             print("Retrieve video annotations tracks...")
             annotations = video_annotations.get_annotations_tracks(self.annotation_path, self.reproj_cameras)
             annotations = annotations.rename(columns={"image_name": "filename"})
             if self.wholeframe_only:
                 annotations = annotations[annotations['shape_name'] == 'WholeFrame']
         else:
-            annotations = pd.read_csv(self.annotation_path, sep=",")
-            annotations['points'] = annotations['points'].apply(lambda x: ast.literal_eval(x))
+            annotations = load_report(self.annotation_path).annotations()
+
+        self.running = True
+        writer = ReprojectionWriter(self.reprojected_annotations_dir, self.run_key())
+        cameras = self.reproj_cameras[~self.reproj_cameras['image_name'].isin(writer.completed_images)]
+        if writer.completed_images:
+            print(f"Resuming reprojection, {len(writer.completed_images)} images already done")
+        if self.hit_maps_dir is None:
+            print("Casting annotation rays...")
+            results = self.reproject_images(self.cast_annotation_rays(annotations, cameras), annotations)
+        elif self.nb_processes > 1:
+            results = self.reproject_images_parallel(cameras, annotations)
+        else:
+            hit_maps = prefetch((image, *self.get_hit_map(hm)) for image, hm in zip(cameras['image_name'], cameras['hm']))
+            results = self.reproject_images(hit_maps, annotations)
 
-        point = []
-        polygon = []
-        line = []
         print("Starting reprojection...")
-        for image in tqdm(self.reproj_cameras['image_name']):
-            ann_img = annotations.loc[annotations['filename'] == image]
-            result = self.reproject(ann_img, image, False)
-            point.extend(result[0])
-            line.extend(result[1])
-            polygon.extend(result[2])
-            point_pd = pd.DataFrame(point, columns=['points', 'label', 'label_hier', 'filename', 'ann_id', 'radius'])
-            line_pd = pd.DataFrame(line, columns=['points', 'label', 'label_hier', 'filename', 'ann_id'])
-            polygon_pd = pd.DataFrame(polygon, columns=['points', 'label', 'label_hier', 'filename', 'ann_id', "misses"])
-
-            point_pd.to_pickle(os.path.join(self.reprojected_annotations_dir, 'points.pkl'))
-            line_pd.to_pickle(os.path.join(self.reprojected_annotations_dir, 'lines.pkl'))
-            polygon_pd.to_pickle(os.path.join(self.reprojected_annotations_dir, 'polygons.pkl'))
-
-
-        return self.reprojected_annotations_dir
-
-    def reproject(self, annotations, image, label):
-        point = []
-        polygon = []
-        line = []
-        image_info = self.reproj_cameras[self.reproj_cameras['image_name'] == image].iloc[0]
-        hit_map, contour = self.get_hit_map(image_info['hm'])
+        for result in tqdm(results, total=len(cameras)):
+            writer.add(*result)
+            if progress is not None:
+                progress(int(100 * len(writer.completed_images) / len(self.reproj_cameras)))
+            if not self.running:
+                # Keep what was done in the checkpoint, the next run resumes from there
+                writer.flush()
+                results.close()  # Stops the prefetching thread or the pool
+                return None
+
+        return writer.finalize()
+
+    def reproject_images(self, hit_maps, annotations):
+        """Reprojects the images one after the other, yields the image name and its point, line and polygon lists."""
+        by_image = annotations_by_image(annotations)
+        empty = annotations.iloc[0:0]
+        for image, hit_map, contour in hit_maps:
+            yield (image, *self.reproject(by_image.get(image, empty), image, False, hit_map, contour))
+
+    def reproject_images_parallel(self, cameras, annotations):
+        """
+        Reprojects the images with a process pool, every worker opening its own hit maps.
+
+        Results are yielded in the camera table order, whatever the order the workers finish.
+        """
+        by_image = annotations_by_image(annotations)
+        empty = annotations.iloc[0:0]
+        tasks = ((image, hm, by_image.get(image, empty)) for image, hm in zip(cameras['image_name'], cameras['hm']))
+        with mp.Pool(processes=self.nb_processes, initializer=reproject_kernel.init_worker,
+                     initargs=(self.hit_maps_dir, self.min_radius)) as pool:
+            # imap keeps a few tasks ahead of each worker, so hit map reads overlap the computations
+            yield from pool.imap(reproject_kernel.reproject_task, tasks)
+
+    def stop(self):
+        self.running = False
+
+    def run_key(self):
+        """Identifies the inputs of a reprojection, to only resume a checkpoint of the same run."""
+        inputs = [self.annotation_path, self.hit_maps_dir, self.model]
+        stats = [(os.path.getmtime(path), os.path.getsize(path)) for path in inputs
+                 if path is not None and os.path.isfile(path)]
+        return repr((inputs, stats, self.report_type, self.wholeframe_only))
+
+    def reproject(self, annotations, image, label, hit_map=None, contour=None):
+        if hit_map is None:
+            hit_map, contour = self.get_hit_map(self.reproj_cameras.at[image, 'hm'])
         if label:
             annotations['shape_name'] = 'WholeFrame'
             annotations['points'] = contour
             annotations['annotation_id'] = -999
-        else:
-            image_bound = pd.DataFrame({
-                'filename': [image],
-                'shape_name': ['WholeFrame'],
-                'points': [contour],
-                'label_name': ['bound'],
-                'label_hierarchy': ['bound'],
-                'annotation_id': [-999],
-            })
-            annotations = pd.concat([annotations, image_bound])
-
-        for index, ann in annotations.iterrows():  # for each annotation
-            if ann['shape_name'] == 'Circle':  # if the annotation is a point or a circle
-                x, y = ann['points'][:2]
-
-                # get the location of the intersection between ray and target
-                coord = self.annotation2hitpoint((x, y), hit_map)
-
-                if coord is not None:  # If we have a hit point
-                    # If the annotation is a circle, we try to get an approximate radius by looking
-                    # North, South, East and West from the center. We then keep the minimal distance
-                    # obtained
-                    radius = []  # min arbitrary value
-                    r = ann['points'][2]
-                    list_coord_r = [(x + r, y), (x - r, y), (x, y + r), (x, y - r)]
-                    for i in list_coord_r:
-                        # get the location of the intersection between ray and target
-                        coord_radius = self.annotation2hitpoint((i[0], i[1]), hit_map)
-
-                        if coord_radius is not None:
-                            ct = [coord[0], coord[1]]
-                            off = [coord_radius[0], coord_radius[1]]
-                            radius.append(dist(ct, off))
-                    radius = min(radius, default=self.min_radius)
-                    point.append([[coord[0], coord[1], coord[2]], ann['label_name'], ann['label_hierarchy'],
-                                  ann['filename'],
-                                  ann['annotation_id'], radius])
-
-            elif ann['shape_name'] == 'Point':  # if the annotation is a point or a circle
-                x, y = ann['points'][:2]
-
-                # get the location of the intersection between ray and target
-                coord = self.annotation2hitpoint((x, y), hit_map)
-
-                if coord is not None:  # If we have a hit point
-                    radius = 0
-                    point.append([[coord[0], coord[1], coord[2]], ann['label_name'], ann['label_hierarchy'],
-                                  ann['filename'],
-                                  ann['annotation_id'], radius])
-
-            elif ann['shape_name'] == 'LineString':  # if geometry is a line
-                list_coord = list(zip(*[iter(ann['points'])] * 2))
-                points_out = []
-                for i in list_coord:
-                    # get the location of the intersection between ray and target
-                    coord = self.annotation2hitpoint((i[0], i[1]), hit_map)
-                    if coord is not None:
-                        points_out.append([coord[0], coord[1], coord[2]])
-                if points_out:
-                    line.append(
-                        [points_out, ann['label_name'], ann['label_hierarchy'], ann['filename'],
-                         ann['annotation_id']])
-
-            elif ann['shape_name'] in ['Polygon', 'Rectangle', "WholeFrame"]:  # if geometry is a polygon or rectangle
-                if ann['shape_name'] == "WholeFrame":
-                    vertexes = contour
-                else:
-                    vertexes = ann['points']
-                list_coord = list(zip(*[iter(vertexes)] * 2))
-                points_out = []
-                count = 0
-                misses_list = []
-                for i in list_coord:  # For all the points of the polygone
-                    # get the location of the intersection between ray and target
-                    coord = self.annotation2hitpoint((i[0], i[1]), hit_map)
-
-                    if coord is not None:
-                        points_out.append([coord[0], coord[1], coord[2]])
-                    else:
-                        count+=1
-                if points_out:  # If more than one point exist
-                    polygon.append([points_out, ann['label_name'], ann['label_hierarchy'], ann['filename'], ann['annotation_id'], count])
-
-        return point, line, polygon
+
+        return reproject_kernel.reproject_image(annotations, image, hit_map, contour, self.min_radius,
+                                                add_bound=not label)
 
 
 class reprojector(QtCore.QThread):
     prog_val = QtCore.pyqtSignal(int)
     finished = QtCore.pyqtSignal()
 
-    def __init__(self, model, sfm, export):
+    def __init__(self, model, sfm, export, nb_processes=None, hit_map_format=HIT_MAP_DENSE, store_path=None):
+        """
+        hit_map_format: HIT_MAP_DENSE float16 XYZ hit maps, as read by the other tools, or HIT_MAP_COMPACT
+        depth maps (opt-in).
+        store_path: If not None, the hit maps are also packed into this single-file store (.hms)
+        once they are all computed (see reprojection.hit_map_store).
+        """
         super(reprojector, self).__init__()
         self.running = True
 
         self.export = export
-        mesh = trimesh.load(model)
-        self.intersector = trimesh.ray.ray_pyembree.RayMeshIntersector(mesh)
-        self.scene = trimesh.Scene([mesh])
+        self.hit_map_format = hit_map_format
+        self.store_path = store_path
+        self.model = model
+        self.mesh = trimesh.load(model)
+        self.nb_processes = nb_processes if nb_processes is not None else os.cpu_count()
 
         self.cams = OpenMVGJSONFileHandler.parse_openmvg_file(sfm, "NAME", True)
 
     def run(self):
         try:
-            tot_len = len(self.cams)
-            for prog, cam in enumerate(self.cams, start=1):
-                hit_map = self.convert_to_hit_map(cam)
-                self.save_hit_map(cam, hit_map)
-                self.prog_val.emit(round((prog / tot_len) * 100))
+            tasks = hit_map_engine.camera_tasks(self.cams, self.export, self.hit_map_format)
+            tot_len = len(tasks)
+            manifest = hit_map_engine.HitMapManifest(self.export)
+            mesh_digest = utility.file_digest(self.model)
+            tasks, hashes = hit_map_engine.pending_tasks(tasks, manifest, mesh_digest)
+            nb_skipped = tot_len - len(tasks)
+            if nb_skipped != 0:
+                print(f"{nb_skipped} hit maps up to date, {len(tasks)} to compute")
+            if len(tasks) != 0:
+                with hit_map_engine.SharedMesh(self.mesh) as shared_mesh:
+                    with mp.Pool(processes=self.nb_processes, initializer=hit_map_engine.init_worker,
+                                 initargs=shared_mesh.descriptors) as pool:
+                        results = pool.imap_unordered(hit_map_engine.hit_map_task, tasks)
+                        for prog, (export_path, hit_map_path) in enumerate(results, start=nb_skipped + 1):
+                            manifest.add(export_path, hit_map_path, hashes[export_path])
+                            self.prog_val.emit(round((prog / tot_len) * 100))
+                            if not self.running:
+                                pool.terminate()
+                                break
+            if self.running and self.store_path is not None:
+                convert_hit_maps_dir(self.export, self.store_path)
 
         except RuntimeError:
             self.gui.normalOutputWritten("An error occurred")
@@ -220,26 +350,35 @@ class reprojector(QtCore.QThread):
         self.finished.emit()
         self.running = False
 
-    def save_hit_map(self, cam, hit_map):
-        export_path = os.path.join(self.export, cam.get_relative_fp())
-        np.save(export_path, hit_map)
-
-    def convert_to_hit_map(self, cam):
-        trsf_matrix, fov, shift, focal_length, res, dist = camera.get_cam_parameters(cam)
-
-        self.scene.camera.resolution = res
-        self.scene.camera.fov = np.rad2deg(fov)
-
-        self.scene.camera_transform = trsf_matrix
-
-        # convert the camera to rays with one ray per pixel
-        origins, vectors, pixels = self.scene.camera_rays()
-        points, index_ray, index_tri = self.intersector.intersects_location(
-            origins, vectors, multiple_hits=False)
-        # find pixel locations of actual hits
-        pixel_ray = pixels[index_ray]
-        # create a numpy array we can turn into an image
-        # doing it with uint8 creates an `L` mode greyscale image
-        a = np.zeros(np.append(res, 3), dtype=np.float16)
-        a[pixel_ray[:, 0], pixel_ray[:, 1]] = points
-        return a
+    def stop(self):
+        """Stops after the hit map being completed, the next run resumes from there."""
+        self.running = False
+
+
+class annotationReprojector(QtCore.QThread):
+    """
+    Runs annotationTo3D.reproject_annotations out of the GUI thread. reprojection_done is always
+    emitted, with output_dir None if stopped and error set if the reprojection failed.
+    """
+    prog_val = QtCore.pyqtSignal(int)
+    reprojection_done = QtCore.pyqtSignal()
+
+    def __init__(self, annotation_to_3d):
+        super(annotationReprojector, self).__init__()
+        self.running = True
+        self.annotation_to_3d = annotation_to_3d
+        self.output_dir = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.output_dir = self.annotation_to_3d.reproject_annotations(progress=self.prog_val.emit)
+        except Exception as e:  # An exception escaping run would abort the application
+            self.output_dir = None
+            self.error = e
+        finally:
+            self.running = False
+            self.reprojection_done.emit()
+
+    def stop(self):
+        self.annotation_to_3d.stop()
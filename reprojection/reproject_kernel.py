@@ -0,0 +1,186 @@
+"""
+Vectorized reprojection of the annotations of one image.
+
+The vertices of all the annotations of a shape family are flattened in one coordinate array,
+bounds-checked with masks and looked up in the hit map with a single fancy-index. Per
+annotation results are then rebuilt from the vertex offsets.
+
+reproject_task is the process pool entry point of the parallel reprojection: every worker opens
+its own hit maps (memory-mapped when they are in a hit map store) and reprojects one image.
+"""
+import itertools
+
+import numpy as np
+
+from reprojection.contour_finding import find_contour
+from reprojection.hit_map_io import hit_map_mask, load_footprint, load_hit_map
+from reprojection.hit_map_store import HitMapStore, is_hit_map_store
+
+POINT_SHAPES = ['Circle', 'Point']
+LINE_SHAPES = ['LineString']
+POLYGON_SHAPES = ['Polygon', 'Rectangle', 'WholeFrame']
+
+
+def lookup(coords, hit_map):
+    """
+    Gets the 3D locations of annotation coordinates.
+
+    Args:
+        coords: The (n, 2) annotation space (x, y) coordinates (y axis pointing down).
+        hit_map: The hit map, dense array or any hit map indexed as hit_map[x, y].
+
+    Returns:
+        tuple: The (n, 3) locations and the (n,) mask of the coordinates that are inside the image and hit the model.
+    """
+    width, height = hit_map.shape[:2]
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    x, y = coords[:, 0], coords[:, 1]
+    inside = (0 <= x) & (x < width) & (0 <= y) & (y < height)
+    px = np.zeros(len(coords), dtype=np.int64)
+    py = np.zeros(len(coords), dtype=np.int64)
+    px[inside] = x[inside]
+    py[inside] = height - y[inside]  # Inverse Y axis
+    inside &= py < height
+    xyz = np.zeros((len(coords), 3))
+    if inside.any():
+        xyz[inside] = hit_map[px[inside], py[inside]]
+    return xyz, inside & np.any(xyz != 0, axis=1)
+
+
+def flatten_vertices(points_list):
+    """
+    Flattens the [x0, y0, x1, y1, ...] vertex lists of several annotations.
+
+    Returns:
+        tuple: The (n, 2) vertex coordinates and the offsets of each annotation in them.
+    """
+    lengths = np.array([len(points) // 2 for points in points_list], dtype=np.int64)
+    flat = itertools.chain.from_iterable(points[:2 * n] for points, n in zip(points_list, lengths))
+    vertices = np.fromiter(flat, dtype=float, count=2 * int(lengths.sum())).reshape(-1, 2)
+    return vertices, np.concatenate(([0], np.cumsum(lengths)))
+
+
+def _reproject_points(points_list, is_circle, hit_map, min_radius):
+    centers = np.array([points[:2] for points in points_list], dtype=float).reshape(-1, 2)
+    xyz, hit = lookup(centers, hit_map)
+    radius = np.zeros(len(centers))
+    if is_circle.any():
+        # For circles, we try to get an approximate radius by looking North, South, East and
+        # West from the center. We then keep the minimal (horizontal) distance obtained
+        r = np.array([points_list[i][2] for i in np.flatnonzero(is_circle)], dtype=float)
+        c = centers[is_circle]
+        zeros = np.zeros_like(r)
+        around = np.stack([c + np.column_stack((r, zeros)), c - np.column_stack((r, zeros)),
+                           c + np.column_stack((zeros, r)), c - np.column_stack((zeros, r))], axis=1)
+        around_xyz, around_hit = lookup(around.reshape(-1, 2), hit_map)
+        around_xyz = around_xyz.reshape(-1, 4, 3)
+        around_hit = around_hit.reshape(-1, 4)
+        d = np.hypot(around_xyz[..., 0] - xyz[is_circle, None, 0], around_xyz[..., 1] - xyz[is_circle, None, 1])
+        d = np.where(around_hit, d, np.inf).min(axis=1)
+        radius[is_circle] = np.where(np.isinf(d), min_radius, d)
+    return xyz, hit, radius
+
+
+def _reproject_vertices(points_list, hit_map):
+    vertices, offsets = flatten_vertices(points_list)
+    xyz, hit = lookup(vertices, hit_map)
+    cum_hits = np.concatenate(([0], np.cumsum(hit)))
+    nb_hits = cum_hits[offsets[1:]] - cum_hits[offsets[:-1]]
+    misses = np.diff(offsets) - nb_hits
+    hit_xyz = xyz[hit]
+    hit_offsets = cum_hits[offsets]
+    return [hit_xyz[hit_offsets[k]:hit_offsets[k + 1]].tolist() for k in range(len(points_list))], misses
+
+
+def reproject_image(annotations, image, hit_map, contour, min_radius=0.01, add_bound=True):
+    """
+    Reprojects all the annotations of one image.
+
+    Args:
+        annotations: The annotations of the image (shape_name, points, label_name, label_hierarchy, filename, annotation_id).
+        image: The image name.
+        hit_map: The hit map of the image.
+        contour: The image footprint contour, used for WholeFrame annotations.
+        min_radius: The radius of circles whose radius could not be measured.
+        add_bound: Also reproject the image footprint as a 'bound' WholeFrame annotation.
+
+    Returns:
+        tuple: The point, line and polygon lists, same rows as the reprojected DataFrames.
+    """
+    shape_names = annotations['shape_name'].tolist()
+    points_list = annotations['points'].tolist()
+    attributes = list(zip(annotations['label_name'].tolist(), annotations['label_hierarchy'].tolist(),
+                          annotations['filename'].tolist(), annotations['annotation_id'].tolist()))
+    if add_bound:
+        shape_names.append('WholeFrame')
+        points_list.append(contour)
+        attributes.append(('bound', 'bound', image, -999))
+    shape_names = np.array(shape_names, dtype=object)
+    points_list = [contour if shape == 'WholeFrame' else points for shape, points in zip(shape_names, points_list)]
+
+    point = []
+    line = []
+    polygon = []
+
+    index = np.flatnonzero(np.isin(shape_names, POINT_SHAPES))
+    if len(index) != 0:
+        xyz, hit, radius = _reproject_points([points_list[i] for i in index], shape_names[index] == 'Circle',
+                                             hit_map, min_radius)
+        for k in np.flatnonzero(hit):
+            point.append([xyz[k].tolist(), *attributes[index[k]], float(radius[k])])
+
+    index = np.flatnonzero(np.isin(shape_names, LINE_SHAPES))
+    if len(index) != 0:
+        lines, misses = _reproject_vertices([points_list[i] for i in index], hit_map)
+        for k, points_out in enumerate(lines):
+            if points_out:
+                line.append([points_out, *attributes[index[k]]])
+
+    index = np.flatnonzero(np.isin(shape_names, POLYGON_SHAPES))
+    if len(index) != 0:
+        polygons, misses = _reproject_vertices([points_list[i] for i in index], hit_map)
+        for k, points_out in enumerate(polygons):
+            if points_out:
+                polygon.append([points_out, *attributes[index[k]], int(misses[k])])
+
+    return point, line, polygon
+
+
+def open_hit_map(hit_map_path, hit_map_store=None):
+    """
+    Loads the hit map of one image and its footprint contour.
+
+    Args:
+        hit_map_path: The hit map file, or the image name in the hit map store.
+        hit_map_store: The HitMapStore of the hit maps, if any.
+
+    Returns:
+        tuple: The hit map and the footprint contour.
+    """
+    if hit_map_store is not None:
+        hit_map = hit_map_store[hit_map_path]
+        footprint = hit_map_store.footprint(hit_map_path)
+    else:
+        hit_map = load_hit_map(hit_map_path)
+        footprint = load_footprint(hit_map_path)
+    if footprint is not None:
+        return hit_map, footprint['contour']
+    # Hit maps generated before the footprint sidecars
+    return hit_map, find_contour(hit_map_mask(hit_map))
+
+
+# Per-process state of a pool worker (hit map store and reprojection parameters)
+_worker = {}
+
+
+def init_worker(hit_maps_dir, min_radius):
+    """Pool initializer: memory-map the hit map store once per worker."""
+    _worker['store'] = HitMapStore(hit_maps_dir) if is_hit_map_store(hit_maps_dir) else None
+    _worker['min_radius'] = min_radius
+
+
+def reproject_task(task):
+    """Pool worker: reprojects the annotations of one image, returns the image name and the point, line and polygon lists."""
+    image, hit_map_path, annotations = task
+    hit_map, contour = open_hit_map(hit_map_path, _worker['store'])
+    return (image, *reproject_image(annotations, image, hit_map, contour, _worker['min_radius']))
@@ -0,0 +1,100 @@
+"""
+Streaming writer of the reprojected annotations.
+
+Per image results are buffered and appended in batches to a checkpoint file
+(`reprojection.partial` in the output directory), as a sequence of pickled records. The points,
+lines and polygons columnar stores (see annotation_store) are only written once, by finalize,
+which then removes the checkpoint. If the reprojection is interrupted, the next run with the
+same inputs reads the complete records back and skips the images they cover.
+"""
+import os
+import pickle
+
+from reprojection.annotation_store import save_reprojected
+
+CHECKPOINT_NAME = 'reprojection.partial'
+
+
+class ReprojectionWriter:
+    """Append-only writer of per image reprojection results, finalized into the points, lines and polygons stores."""
+
+    def __init__(self, out_dir, run_key, flush_every=50):
+        """
+        Args:
+            out_dir: The reprojected annotations directory.
+            run_key: Identifies the inputs of the run (annotation file, hit maps), a checkpoint of another run is discarded.
+            flush_every: Number of images buffered before they are appended to the checkpoint.
+        """
+        self.out_dir = out_dir
+        self.run_key = run_key
+        self.flush_every = flush_every
+        self.checkpoint_path = os.path.join(out_dir, CHECKPOINT_NAME)
+
+        self.completed_images = set()
+        self.point = []
+        self.line = []
+        self.polygon = []
+        self._pending = []
+
+        if not self._resume():
+            with open(self.checkpoint_path, 'wb') as f:
+                pickle.dump({'run_key': run_key}, f)
+
+    def _resume(self):
+        """Reads back the complete records of a previous run with the same key, returns False if there is none."""
+        if not os.path.isfile(self.checkpoint_path):
+            return False
+        with open(self.checkpoint_path, 'rb') as f:
+            try:
+                header = pickle.load(f)
+            except Exception:
+                return False
+            if not isinstance(header, dict) or header.get('run_key') != self.run_key:
+                return False
+            end = f.tell()
+            while True:
+                try:
+                    records = pickle.load(f)
+                except Exception:  # End of file, or record truncated by a crash
+                    break
+                for image, point, line, polygon in records:
+                    self._extend(image, point, line, polygon)
+                end = f.tell()
+        # Drop a truncated last record so that new ones are appended after the complete ones
+        with open(self.checkpoint_path, 'r+b') as f:
+            f.truncate(end)
+        return True
+
+    def _extend(self, image, point, line, polygon):
+        self.completed_images.add(image)
+        self.point.extend(point)
+        self.line.extend(line)
+        self.polygon.extend(polygon)
+
+    def add(self, image, point, line, polygon):
+        """Adds the reprojected point, line and polygon rows of one image."""
+        self._extend(image, point, line, polygon)
+        self._pending.append((image, point, line, polygon))
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Appends the buffered images to the checkpoint."""
+        if self._pending:
+            with open(self.checkpoint_path, 'ab') as f:
+                pickle.dump(self._pending, f)
+            self._pending = []
+
+    def finalize(self):
+        """
+        Writes the points, lines and polygons stores and removes the checkpoint.
+
+        Returns:
+            str: The reprojected annotations directory.
+        """
+        save_reprojected(self.out_dir, self.point, self.line, self.polygon)
+
+        self._pending = []
+        if os.path.isfile(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        return self.out_dir
@@ -14,8 +14,12 @@ class rpDialog(QDialog, Ui_Dialog_reproj):
         self.project_config = qt.project_config
         self.hit_map_launch.clicked.connect(self.launch_get_hit_maps)
         self.reproject_launch.clicked.connect(self.launch_reprojection)
+        self.rejected.connect(self.stop_get_hit_maps)
+        self.rejected.connect(self.stop_reprojection)
 
         self.reprojector = None
+        self.annotation_reprojector = None
+        self.reprojection_report = None
         self.annotations_list = None
 
         self.models_list = self.project_config['outputs']['3D_models']
@@ -23,16 +27,19 @@ class rpDialog(QDialog, Ui_Dialog_reproj):
             item_list = [x['name'] for x in self.models_list]
             self.models3D.addItems(item_list)
 
-        if len(self.project_config['inputs']['annotations']) != 0 and self.project_config['outputs']['hit_maps'] != '':
+        if len(self.project_config['inputs']['annotations']) != 0 and (
+                self.project_config['outputs']['hit_maps'] != '' or len(self.models_list) != 0):
             self.enable_reproject()
 
     def set_prog(self, val):
         self.progressBar.setValue(val)
 
     def enable_reproject(self):
-        obj_to_enable = [self.label_3, self.annotation_cb, self.reproject_launch, self.wholeframe_only]
+        obj_to_enable = [self.label_3, self.annotation_cb, self.reproject_launch, self.wholeframe_only, self.direct_raycast]
         for obj in obj_to_enable:
             obj.setDisabled(False)
+        if self.project_config['outputs']['hit_maps'] == '':
+            self.direct_raycast.setChecked(True)
 
         self.annotations_list = self.project_config['inputs']['annotations']
         if len(self.annotations_list) != 0:
@@ -40,14 +47,18 @@ class rpDialog(QDialog, Ui_Dialog_reproj):
             self.annotation_cb.addItems(item_list)
         print("ok")
 
-    def launch_get_hit_maps(self):
-        project_path = self.project_config['project_directory']
-        exp_path = utility.create_dir(os.path.join(project_path,'hit_maps'))
+    def get_model(self):
         model_name = self.models3D.currentText()
         model = None
         for x in self.models_list:
             if x['name'] == model_name:
                 model = x
+        return model
+
+    def launch_get_hit_maps(self):
+        project_path = self.project_config['project_directory']
+        exp_path = utility.create_dir(os.path.join(project_path,'hit_maps'))
+        model = self.get_model()
         if model is not None:
             model_path = model['model_path']
             sfm_path = model['sfm']
@@ -57,6 +68,11 @@ class rpDialog(QDialog, Ui_Dialog_reproj):
             self.reprojector.finished.connect(self.end_get_hit_maps)
             self.reprojector.start()
 
+    def stop_get_hit_maps(self):
+        if self.reprojector is not None and self.reprojector.running:
+            self.reprojector.stop()
+            self.reprojector.wait()
+
     def end_get_hit_maps(self):
         self.set_prog(0)
         self.project_config['outputs']['hit_maps'] = os.path.join(self.project_config['project_directory'], 'hit_maps')
@@ -78,15 +94,41 @@ class rpDialog(QDialog, Ui_Dialog_reproj):
             reprojected_annotation_path = os.path.join(self.project_config['project_directory'], "reprojected_annotations")
             utility.create_dir(reprojected_annotation_path)
 
-            self.annotation_reprojector = reproject.annotationTo3D(rep_path, hit_maps_path, rep_type, self.wholeframe_only.isChecked(), reprojected_annotation_path)
-
-            output_dir = self.annotation_reprojector.reproject_annotations()
-            self.project_config['outputs']['reprojected_annotations'].append({
-                "reprojected_annotation_dir": output_dir,
-                "report_path": rep_path,
-                "report_type": rep_type,
-                "report_name": rep_name,
-            })
-
-
+            if self.direct_raycast.isChecked():
+                model = self.get_model()
+                if model is None:
+                    self.qt.normalOutputWritten("Error: missing 3D model for direct ray casting \r")
+                    return
+                annotation_to_3d = reproject.annotationTo3D(
+                    rep_path, None, rep_type, self.wholeframe_only.isChecked(), reprojected_annotation_path,
+                    model=model['model_path'], sfm=model['sfm'])
+            else:
+                annotation_to_3d = reproject.annotationTo3D(rep_path, hit_maps_path, rep_type, self.wholeframe_only.isChecked(), reprojected_annotation_path,
+                                                            nb_processes=os.cpu_count())
+
+            self.reprojection_report = {"report_path": rep_path, "report_type": rep_type, "report_name": rep_name}
+            self.reproject_launch.setDisabled(True)
+            self.annotation_reprojector = reproject.annotationReprojector(annotation_to_3d)
+            self.annotation_reprojector.prog_val.connect(self.set_prog)
+            self.annotation_reprojector.reprojection_done.connect(self.end_reprojection)
+            self.annotation_reprojector.start()
+
+    def stop_reprojection(self):
+        if self.annotation_reprojector is not None and self.annotation_reprojector.running:
+            self.annotation_reprojector.stop()
+            self.annotation_reprojector.wait()
+
+    def end_reprojection(self):
+        self.set_prog(0)
+        self.reproject_launch.setDisabled(False)
+        if self.annotation_reprojector.error is not None:
+            self.qt.normalOutputWritten(f"Error: reprojection failed: {self.annotation_reprojector.error} \r")
+            return
+        output_dir = self.annotation_reprojector.output_dir
+        if output_dir is None:  # Stopped, the next reprojection resumes from the checkpoint
+            return
+        self.project_config['outputs']['reprojected_annotations'].append({
+            "reprojected_annotation_dir": output_dir,
+            **self.reprojection_report,
+        })
         print("Reprojection done !")
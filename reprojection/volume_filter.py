@@ -1,118 +1,229 @@
 import os
+import multiprocessing as mp
 import pandas as pd
 import numpy as np
-import pyvista as pv
-from statistics import mean, stdev, median, quantiles
 from pv_utils import parse_point_clouds
+from geomorphometrics.cloud_index import CloudGridIndex, load_cloud_index
+from reprojection.imprint_prism import ImprintPrism, points_in_prism
 from tqdm import tqdm
 
-def mesh_to_volume(mesh):
-    mesh.compute_normals(inplace=True)
-    mesh.compute_normals(cell_normals=True, point_normals=False, inplace=True)
-    normals = np.asarray(mesh['Normals'])
-    vect = np.asarray([mean(normals[:, 0]), mean(normals[:, 1]), mean(normals[:, 2])])
-    mesh_bottom = mesh.translate(-vect, inplace=True)
-    return mesh_bottom.extrude(4 * vect, capping=True)
-
-def extract_points_in_volume(point_cloud, vol):
-    result = point_cloud.select_enclosed_points(vol, tolerance=0, check_surface=False)
-    return point_cloud.extract_points(
-        result['SelectedPoints'].view(bool),
-        adjacent_cells=False,
-    )
+SUMMARY_COLUMNS = ['metrics_name', 'mean', 'sd', 'median', 'q1', "q3"]
+
+
+def volume_mask(point_cloud, vol, index=None, mask=None):
+    """
+    Args:
+        point_cloud: The pyvista point cloud.
+        vol: The ImprintPrism of an annotation.
+        index: The CloudGridIndex of the point cloud, built if None.
+        mask: A boolean mask over the cloud points to add the volume points to, a new one if None.
+
+    Returns:
+        numpy.ndarray: The mask of the points of the cloud inside the volume (or in mask).
+    """
+    if index is None:
+        index = CloudGridIndex.build(point_cloud.points)
+    if mask is None:
+        mask = np.zeros(point_cloud.n_points, dtype=bool)
+    mask[points_in_prism(index, vol)] = True
+    return mask
+
+
+def extract_points_in_volume(point_cloud, vol, index=None):
+    """
+    Args:
+        point_cloud: The pyvista point cloud.
+        vol: The ImprintPrism of an annotation.
+        index: The CloudGridIndex of the point cloud, built if None.
+
+    Returns:
+        pyvista.UnstructuredGrid: The points of the cloud inside the volume.
+    """
+    return point_cloud.extract_points(volume_mask(point_cloud, vol, index), adjacent_cells=False)
+
 
 def imprint_to_volume(points):
-    points = list(list(map(float, pt)) for pt in points)
-    polygons_pts = pv.PolyData(points)
-    mesh = polygons_pts.delaunay_2d()
-    return mesh_to_volume(mesh)
+    return ImprintPrism(np.asarray(points, dtype=np.float64))
 
 
-def list_imprint_to_list_volumes(track):
+def list_imprint_to_list_volumes(imprints):
     vol_list = []
-    for points in track['points']:
+    for points in imprints:
         vol = imprint_to_volume(points)
         vol_list.append(vol)
     return vol_list
 
 
-def extract_all_points_in_volumes(point_cloud, v_list):
-    result = None
+def extract_all_points_in_volumes(point_cloud, v_list, index=None):
+    """
+    Args:
+        point_cloud: The pyvista point cloud.
+        v_list: The ImprintPrism of every annotation of a track.
+        index: The CloudGridIndex of the point cloud, built if None.
+
+    Returns:
+        pyvista.UnstructuredGrid: The points of the cloud inside any of the volumes, each point once.
+    """
+    if index is None:
+        index = CloudGridIndex.build(point_cloud.points)
+    # Union of the memberships over the source cloud, extracted once
+    mask = np.zeros(point_cloud.n_points, dtype=bool)
     for vol in tqdm(v_list):
-        inside = extract_points_in_volume(point_cloud, vol)
-        if result is None:
-            result = inside.extract_surface()
-        else:
-            result += inside.extract_surface()
-            result = result.clean()
-    return result
-
-def point_cloud_stat_summary(point_cloud):
+        volume_mask(point_cloud, vol, index, mask)
+    return point_cloud.extract_points(mask, adjacent_cells=False)
+
+
+def _sorted_quantile(sorted_values, j, delta, n):
+    """The (data[j - 1] * (n - delta) + data[j] * delta) / n interpolation of every row."""
+    low = np.take_along_axis(sorted_values, (j - 1)[:, None], axis=1)[:, 0]
+    high = np.take_along_axis(sorted_values, j[:, None], axis=1)[:, 0]
+    return (low * (n - delta) + high * delta) / n
+
+
+def point_cloud_stat_summary(point_cloud, suffix=None):
     names = point_cloud.array_names
     names = [x for x in names if not x.startswith("vtkOriginal")]
+    if suffix is not None:  # Metrics of one scale of a multi-scale cloud
+        names = [x for x in names if x.endswith(suffix)]
     metrics = []
-    if point_cloud.number_of_points != 0:
-        for name in names:  # For each metric
-            point_cloud.set_active_scalars(name)
-            sf = np.asarray(point_cloud[name])  # activate and retrieve the metric
-            sf = sf[~np.isnan(sf)]  # Remove any nan values
-            if len(sf) != 0:
-                # Summarise the metric
-                m = mean(sf)
-                sd = stdev(sf)
-                med = median(sf)
-                q1, q2, q3 = quantiles(sf)
-            else:
-                m = sd = med = q1 = q3 = np.nan
-            metrics.append([name, m, sd, med, q1, q3])
+    if point_cloud.number_of_points != 0 and len(names) != 0:
+        # One row per metric, summarised all at once ignoring the nan values (sorted last)
+        values = np.vstack([np.asarray(point_cloud[name], dtype=np.float64).reshape(-1) for name in names])
+        values.sort(axis=1)
+        counts = np.count_nonzero(~np.isnan(values), axis=1)
+        m, sd, med, q1, q3 = (np.full(len(names), np.nan) for _ in range(5))
+
+        valid = counts != 0
+        m[valid] = np.nanmean(values[valid], axis=1)
+        c = counts[valid]
+        med[valid] = (np.take_along_axis(values[valid], ((c - 1) // 2)[:, None], axis=1)[:, 0]
+                      + np.take_along_axis(values[valid], (c // 2)[:, None], axis=1)[:, 0]) / 2
+
+        several = counts >= 2  # stdev and quantiles need two values
+        sd[several] = np.nanstd(values[several], axis=1, ddof=1)
+        # Quartiles as statistics.quantiles (exclusive method, clamped to 1 .. n - 1)
+        c = counts[several]
+        for i, q in [(1, q1), (3, q3)]:
+            j = np.clip(i * (c + 1) // 4, 1, c - 1)
+            q[several] = _sorted_quantile(values[several], j, i * (c + 1) - j * 4, 4)
+        metrics = [list(row) for row in zip(names, m, sd, med, q1, q3)]
     return metrics
 
-def summarise_track(point_cloud, track):
-    vol_list = list_imprint_to_list_volumes(track)
-    extracted_point_cloud = extract_all_points_in_volumes(point_cloud, vol_list)
-    metrics = point_cloud_stat_summary(extracted_point_cloud)
-    metrics_pd = pd.DataFrame(metrics, columns=['metrics_name', 'mean', 'sd', 'median', 'q1', "q3"])
-    metrics_pd['track'] = track['ann_id']
+
+def summarise_track(point_cloud, ann_id, imprints, index=None, suffix=None):
+    """Summary of the points in the union of the volumes of one track (the (n, 3) imprints of one ann_id)."""
+    vol_list = list_imprint_to_list_volumes(imprints)
+    extracted_point_cloud = extract_all_points_in_volumes(point_cloud, vol_list, index)
+    metrics = point_cloud_stat_summary(extracted_point_cloud, suffix)
+    metrics_pd = pd.DataFrame(metrics, columns=SUMMARY_COLUMNS)
+    metrics_pd['track'] = ann_id
     return metrics_pd
 
 
-def summarise_polygon(point_cloud, annotations):
-    vol = imprint_to_volume(annotations["points"])
-    extracted_point_cloud = extract_points_in_volume(point_cloud, vol)
-    metrics = point_cloud_stat_summary(extracted_point_cloud)
-    metrics_pd = pd.DataFrame(metrics, columns=['metrics_name', 'mean', 'sd', 'median', 'q1', "q3"])
-    metrics_pd['track'] = annotations['ann_id']
+def summarise_polygon(point_cloud, ann_id, imprint, index=None, suffix=None):
+    """Summary of the points in the volume of one annotation (its (n, 3) reprojected imprint)."""
+    vol = imprint_to_volume(imprint)
+    extracted_point_cloud = extract_points_in_volume(point_cloud, vol, index)
+    metrics = point_cloud_stat_summary(extracted_point_cloud, suffix)
+    metrics_pd = pd.DataFrame(metrics, columns=SUMMARY_COLUMNS)
+    metrics_pd['track'] = ann_id
     return metrics_pd
 
 
-def stat_summary(geomorphometrics, annotations, vid_tracks_only):
+def split_tracks(annotations):
+    """
+    Splits the reprojected polygons into tracks (ann_id reprojected at least twice) and single
+    annotations, leaving out the image bounds.
+
+    Args:
+        annotations: The ReprojectedGeometries of the polygons.
+
+    Returns:
+        tuple: The tracks [(ann_id, polygon indices)], in order of first appearance, and the
+        indices of the single annotations.
+    """
+    ann_id = annotations.values('ann_id')
+    index = np.flatnonzero(ann_id != -999)
+    ids, inverse, counts = np.unique(ann_id[index], return_inverse=True, return_counts=True)
+    tracked = counts[inverse] >= 2
+    order = np.argsort(inverse[tracked], kind='stable')
+    groups = np.split(index[tracked][order], np.cumsum(counts[counts >= 2])[:-1])
+    tracks = sorted(((int(ann_id[group[0]]), group) for group in groups if len(group) != 0),
+                    key=lambda track: track[1][0])
+    return tracks, index[~tracked]
+
+
+def _concat_summaries(summaries):
+    summaries = [x for x in summaries if x is not None]
+    return pd.concat(summaries, ignore_index=True) if len(summaries) != 0 else None
+
+
+def summarise_scale(geomorphometric, annotations, tracks, non_tracked, vid_tracks_only):
+    """
+    Summaries of the tracks and annotations in the point cloud of one geomorphometric scale.
+
+    Args:
+        geomorphometric: The geomorphometrics entry of the project configuration ('pcd_path', 'scale').
+        annotations: The ReprojectedGeometries of the polygons.
+        tracks: The [(ann_id, polygon indices)] tracks.
+        non_tracked: The indices of the single annotations.
+        vid_tracks_only: Only summarise the tracks.
+
+    Returns:
+        tuple: The polygon and track summaries, with a scale column (None when there is nothing to summarise).
+    """
+    point_cloud = parse_point_clouds([geomorphometric])[0]
+    index = load_cloud_index(geomorphometric['pcd_path'], point_cloud.points)
+    suffix = '_{}_m'.format(str(geomorphometric['scale'])) if geomorphometric.get('multiscale') else None
+    tracks_summary_pd = _concat_summaries(
+        summarise_track(point_cloud, ann_id, [annotations.geometry(i) for i in track], index, suffix)
+        for ann_id, track in tracks)
     polygon_summary_pd = None
-    tracks_summary_pd = None
-    list_point_cloud = parse_point_clouds(geomorphometrics)
-
-    track_ids = annotations['ann_id'].unique().tolist()
-    track_ids.remove(-999)
-    ann_ids = annotations['ann_id'].tolist()
-    track_ids_ = []
-    for id in track_ids:
-        if ann_ids.count(id) >= 2:
-            track_ids_.append(id)
-    tracked_annotations = annotations[annotations['ann_id'].isin(track_ids_)]
-    non_tracked_annotations = annotations[-annotations['ann_id'].isin(track_ids_)]
-
-    for point_cloud in list_point_cloud:
-        if len(tracked_annotations) != 0:
-            tracks_summary_pd = summarise_track(point_cloud, tracked_annotations)
-        if not vid_tracks_only and len(non_tracked_annotations) != 0:
-            polygon_summary_pd = summarise_polygon(point_cloud, non_tracked_annotations)
+    if not vid_tracks_only:
+        ann_ids = annotations.values('ann_id')
+        polygon_summary_pd = _concat_summaries(
+            summarise_polygon(point_cloud, int(ann_ids[i]), annotations.geometry(i), index, suffix)
+            for i in non_tracked)
+    for summary_pd in (polygon_summary_pd, tracks_summary_pd):
+        if summary_pd is not None:
+            summary_pd['scale'] = geomorphometric['scale']
+    return polygon_summary_pd, tracks_summary_pd
+
 
+def _summarise_scale_task(args):
+    return summarise_scale(*args)
+
+
+def stat_summary(geomorphometrics, annotations, vid_tracks_only, nb_processes=None):
+    """
+    Summarises the geomorphometrics in the volumes of the reprojected polygons, at every scale.
+
+    Args:
+        geomorphometrics: The geomorphometrics entries of the project configuration.
+        annotations: The ReprojectedGeometries of the reprojected polygons.
+        vid_tracks_only: Only summarise the tracks.
+        nb_processes: Number of scales summarised in parallel, one worker process per scale (each
+            loading its own cloud), defaults to the number of scales within the number of CPUs.
+
+    Returns:
+        tuple: The polygon and track summaries of all the scales in long format (one row per
+        metric, annotation and scale), None when there is nothing to summarise.
+    """
+    tracks, non_tracked = split_tracks(annotations)
+    tasks = [(geomorphometric, annotations, tracks, non_tracked, vid_tracks_only) for geomorphometric in geomorphometrics]
+    if nb_processes is None:
+        nb_processes = min(len(tasks), os.cpu_count() or 1)
+    if nb_processes > 1 and len(tasks) > 1:
+        with mp.Pool(processes=nb_processes) as pool:
+            results = pool.map(_summarise_scale_task, tasks)
+    else:
+        results = [summarise_scale(*task) for task in tasks]
+
+    polygon_summary_pd = _concat_summaries(polygon for polygon, _ in results)
+    tracks_summary_pd = _concat_summaries(track for _, track in results)
     return polygon_summary_pd, tracks_summary_pd
 
 
 def save_stat_summary(summary_pd, name, output_dir):
     export_path = os.path.join(output_dir, name)
     summary_pd.to_csv(export_path, index=False)
-
-
-
-
@@ -2,7 +2,7 @@ import os
 from volume_filter import stat_summary, save_stat_summary
 from UI.summary_statistics_ui import Ui_Dialog
 from PyQt5.QtWidgets import (QDialog)
-import pandas as pd
+from reprojection.annotation_store import POLYGONS, load_reprojected
 import utility
 
 
@@ -32,8 +32,7 @@ class VolStatDialog(QDialog, Ui_Dialog):
         geomorphometrics = self.project_config["outputs"]["geomorphometrics"]
         output_dir = utility.create_dir(os.path.join(self.project_config['project_directory'], "volume_stat"))
 
-        reproj_annotations_path = os.path.join(reproj_annotations["reprojected_annotation_dir"], "polygons.pkl")
-        annotations = pd.read_pickle(f"{reproj_annotations_path}")
+        annotations = load_reprojected(reproj_annotations["reprojected_annotation_dir"], POLYGONS)
 
         if annotations is not None:
             polygon_summary_pd, tracks_summary_pd = stat_summary(geomorphometrics, annotations, video_tracks_only)
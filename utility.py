@@ -1,5 +1,48 @@
+import hashlib
 import numpy as np
 import os
+from multiprocessing import shared_memory
+
+
+def file_digest(path, chunk_size=2 ** 24):
+    """SHA-1 of a file content, read by chunks."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def share_array(array):
+    """
+    Copies an array into a new shared memory block.
+
+    Args:
+        array: The numpy array to share.
+
+    Returns:
+        tuple: The SharedMemory block and a picklable descriptor (name, shape, dtype).
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(descriptor):
+    """
+    Attaches to an array published with share_array, without copying it.
+
+    Args:
+        descriptor: The (name, shape, dtype) descriptor returned by share_array.
+
+    Returns:
+        tuple: The SharedMemory block (keep a reference to it) and the array view.
+    """
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
 
 
 def create_dir(dir):
@@ -31,14 +74,16 @@ def get_geomorphometric_scalars(project_config, scale):
             if i == 3:
                 break
             i += 1
-    scalars = s.split(' ')
+    scalars = [x.strip() for x in s.split(' ')]
     scalars = [
         x
         for x in scalars
         if not x.startswith("__")
         and not x.startswith("normal_")
-        and x not in ["x", "y", "z", r"_\n", "FIELDS"]
+        and x not in ["x", "y", "z", "_", "", "FIELDS"]
     ]
+    if geomorphometric.get('multiscale'):  # Only the fields of this scale
+        scalars = [x for x in scalars if x.endswith('_{}_m'.format(str(geomorphometric['scale'])))]
     return scalars
 
 
@@ -5,10 +5,11 @@ import numpy as np
 import pandas as pd
 import os, imghdr
 import ast
+from annotation_reports import load_report, sniff_report_type
 
 def report_type(file_path):
     """
-    Determines the type of report based on the file path.
+    Determines the type of report based on the file path, reading its header line only.
 
     Args:
         file_path: The path to the file.
@@ -16,14 +17,7 @@ def report_type(file_path):
     Returns:
         str: The report type ("img" for image or "video" for video).
     """
-    annotations = pd.read_csv(file_path, sep=",")
-    col = annotations.columns[0]
-    report_type = None
-    if col == "annotation_label_id":
-        report_type = "img"
-    elif col == "video_annotation_label_id":
-        report_type = "video"
-    return report_type
+    return sniff_report_type(file_path)
 
 def parse_video_name(file_name):
     name = file_name.rsplit('.', maxsplit=1)[0]
@@ -79,7 +73,8 @@ def get_annotations_tracks(annotation_path, reproj_cameras):
     Returns:
         pandas.DataFrame: A DataFrame containing the annotation tracks.
     """
-    annotations = pd.read_csv(annotation_path, sep=",", )
+    report = load_report(annotation_path)
+    annotations = report.table
 
     video_list_from_annotation = annotations['video_filename'].unique().tolist()
     video_list = {}
@@ -99,38 +94,97 @@ def get_annotations_tracks(annotation_path, reproj_cameras):
     interval = 2  #TODO Set dynamically the interval
 
     # prepare all tracks for reprojection
-    ann_tracks = pd.DataFrame(
-        columns=['timestamp', 'points', 'image_name', 'shape_name', 'label_name', 'label_hierarchy', 'annotation_id'])
+    video_order = {video: i for i, video in enumerate(reprojectable_videos)}
+    annotation_video_order = annotations['video_filename'].astype(object).map(video_order).to_numpy(dtype=float)
+    kept = np.flatnonzero(~np.isnan(annotation_video_order))
+    kept = kept[np.argsort(annotation_video_order[kept], kind='stable')]
+    annotations = annotations.iloc[kept]
+    all_frames = report.frames()
+    all_points = report.points()
+    frames = [all_frames[i] for i in kept]
+    points = [all_points[i] for i in kept]
+    videos = annotations['video_filename'].to_numpy(dtype=object)
+
+    is_interval = np.array([len(f) == 2 for f in frames], dtype=bool)
+    tracks = [_keyframe_tracks(np.flatnonzero(~is_interval), frames, points, videos)]
     for video in reprojectable_videos:
-        annotations_filt = annotations[annotations['video_filename'] == video]
-        img_df_filt = img_df[img_df['video_name'] == video].sort_values(['timestamp'])
-        for index, row in annotations_filt.iterrows():
-            timestamps = ast.literal_eval(row['frames'].replace('null', "'NaN'"))
-            points = ast.literal_eval(row['points'].replace('null', "'NaN'"))
-
-            if len(timestamps) == 2:  # Time interval
-                timestamps_range = []
-                reprojectable_timestamps = img_df_filt['timestamp'].tolist()
-                start, end = timestamps
-                closest_start = min(reprojectable_timestamps, key=lambda x: abs(x - start))
-                closest_end = min(reprojectable_timestamps, key=lambda x: abs(x - end))
-                if closest_start != closest_end:  # if start not after end of reprojectable timestamps and end not before start
-                    index_start = reprojectable_timestamps.index(closest_start)
-                    index_end = reprojectable_timestamps.index(closest_end)
-                    timestamps_range = reprojectable_timestamps[index_start:index_end]
-                tracking = pd.DataFrame({'timestamp': timestamps_range, 'points': [None for i in range(len(timestamps_range))]})
-            else:  # Normal annotation
-                tracking = pd.DataFrame({'timestamp': timestamps,'points': points}).astype({"timestamp": float})
-
-            tracking_merged = pd.merge_asof(tracking, img_df_filt, on='timestamp', direction='nearest', tolerance=interval)
-            tracking_merged = tracking_merged[tracking_merged['image_name'].notnull()]
-            tracking_merged['shape_name'], tracking_merged['label_name'], tracking_merged['label_hierarchy'], tracking_merged['annotation_id'] = [
-                row['shape_name'], row['label_name'], row['label_hierarchy'], row['video_annotation_label_id']]
-            if len(tracking_merged) != 0:
-                ann_tracks = pd.concat([ann_tracks, tracking_merged], ignore_index=True)
-
+        rows = np.flatnonzero(is_interval & (videos == video))
+        if len(rows) != 0:
+            reprojectable_timestamps = np.sort(img_df.loc[img_df['video_name'] == video, 'timestamp'].to_numpy(dtype=float))
+            tracks.append(_interval_tracks(rows, frames, reprojectable_timestamps, video))
+    tracking = pd.concat(tracks, ignore_index=True)
+    tracking = tracking[tracking['timestamp'].notnull()]
+
+    tracking_merged = pd.merge_asof(tracking.sort_values('timestamp', kind='stable'), img_df.sort_values('timestamp', kind='stable'),
+                                    on='timestamp', by='video_name', direction='nearest', tolerance=interval)
+    # Back to the annotations order, then the frames order inside every annotation
+    tracking_merged = tracking_merged[tracking_merged['image_name'].notnull()].sort_values(['row', 'position'], kind='stable')
+
+    rows = tracking_merged['row'].to_numpy()
+    ann_tracks = pd.DataFrame({
+        'timestamp': tracking_merged['timestamp'].to_numpy(),
+        'points': tracking_merged['points'].to_numpy(),
+        'image_name': tracking_merged['image_name'].to_numpy(),
+        'shape_name': annotations['shape_name'].to_numpy(dtype=object)[rows],
+        'label_name': annotations['label_name'].to_numpy(dtype=object)[rows],
+        'label_hierarchy': annotations['label_hierarchy'].to_numpy(dtype=object)[rows],
+        'annotation_id': annotations['video_annotation_label_id'].to_numpy()[rows],
+        'video_name': tracking_merged['video_name'].to_numpy(),
+    })
     return ann_tracks
 
+
+def _keyframe_tracks(rows, frames, points, videos):
+    """One track row per keyframe of the annotations, with the annotation points of that frame."""
+    lengths = np.array([len(frames[row]) for row in rows], dtype=np.int64)
+    row_index = np.repeat(rows, lengths)
+    timestamps = [np.nan if t is None else t for row in rows for t in frames[row]]
+    keyframe_points = [points[row][i] if i < len(points[row]) else None for row in rows for i in range(len(frames[row]))]
+    return pd.DataFrame({
+        'timestamp': np.array(timestamps, dtype=float),
+        'points': pd.Series(keyframe_points, dtype=object),
+        'video_name': videos[row_index],
+        'row': row_index,
+        'position': np.arange(int(lengths.sum())) - np.repeat(np.cumsum(lengths) - lengths, lengths),
+    })
+
+
+def _closest_index(reprojectable_timestamps, x):
+    """
+    Index of the reprojectable timestamp closest to every x, the earliest one on ties.
+
+    Same as reprojectable_timestamps.index(min(reprojectable_timestamps, key=lambda t: abs(t - x)))
+    on a sorted list.
+    """
+    if len(reprojectable_timestamps) == 1:
+        return np.zeros(len(x), dtype=np.int64)
+    i = np.clip(np.searchsorted(reprojectable_timestamps, x), 1, len(reprojectable_timestamps) - 1)
+    before = reprojectable_timestamps[i - 1]
+    after = reprojectable_timestamps[i]
+    closest = np.where(np.abs(x - before) <= np.abs(after - x), before, after)
+    return np.searchsorted(reprojectable_timestamps, closest, side='left')
+
+
+def _interval_tracks(rows, frames, reprojectable_timestamps, video):
+    """Track rows of time interval annotations: every reprojectable timestamp between the closest to start and to end."""
+    start, end = np.array([[np.nan if t is None else t for t in frames[row]] for row in rows], dtype=float).T
+    valid = ~np.isnan(start) & ~np.isnan(end)
+    index_start = np.zeros(len(rows), dtype=np.int64)
+    index_end = np.zeros(len(rows), dtype=np.int64)
+    index_start[valid] = _closest_index(reprojectable_timestamps, start[valid])
+    index_end[valid] = _closest_index(reprojectable_timestamps, end[valid])
+    # Empty if start is after the end of the reprojectable timestamps or end before their start
+    lengths = np.maximum(index_end - index_start, 0)
+    row_index = np.repeat(rows, lengths)
+    position = np.arange(int(lengths.sum())) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return pd.DataFrame({
+        'timestamp': reprojectable_timestamps[np.repeat(index_start, lengths) + position],
+        'points': pd.Series([None] * len(row_index), dtype=object),
+        'video_name': video,
+        'row': row_index,
+        'position': position,
+    })
+
 def frame_to_time(frame_list, start_time):
     """
     Converts a list of frame numbers to corresponding timestamps.